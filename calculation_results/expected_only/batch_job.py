@@ -12,6 +12,9 @@ def main():
     mistake_values = [0.1, 0.01, 0.001, 0.0001, 0.00001]
     epsilon_values = [1e-4, 1e-5, 1e-6]
 
+    # The payoff matrix is the same for every run, so only create it once
+    payoff_matrix = PrisonersDilemmaPayoff()
+
     # For all values of epsilon
     for epsilon in epsilon_values:
 
@@ -21,27 +24,31 @@ def main():
             # for all values of mistake prob
             for mistake_probability in mistake_values:
 
-                # Open a file to write to
-                with open("results_" + str(epsilon) + "_" + str(continuation_probability) + "_" + str(mistake_probability), 'w') as file:
+                # Collect the lines of the file and write them in one go at the end
+                lines = []
 
-                    # Print the parameters for the run
-                    print("Epsilon: " + str(epsilon), file=file)
-                    print("Continuation prob: " + str(continuation_probability), file=file)
-                    print("Mistake prob: " + str(mistake_probability), file=file)
+                # Record the parameters for the run
+                lines.append("Epsilon: " + str(epsilon))
+                lines.append("Continuation prob: " + str(continuation_probability))
+                lines.append("Mistake prob: " + str(mistake_probability))
 
-                    # For each pair of strategies
-                    for strategy_one in iter(strategy_list):
-                        for strategy_two in iter(strategy_list):
+                # For each pair of strategies
+                for strategy_one in strategy_list:
+                    for strategy_two in strategy_list:
 
-                            # Compute the result
-                            results = expected_only(strategy_one, strategy_two, PrisonersDilemmaPayoff(),
-                                    continuation_probability, mistake_probability, epsilon)
+                        # Compute the result
+                        results = expected_only(strategy_one, strategy_two, payoff_matrix,
+                                continuation_probability, mistake_probability, epsilon)
 
-                            # Write the results to the file
-                            print(str(strategy_one.__name__) + "," + str(strategy_two.__name__) + "," + str(results), file=file)
+                        # Record the results
+                        lines.append(str(strategy_one.__name__) + "," + str(strategy_two.__name__) + "," + str(results))
+
+                # Write the results to a file
+                with open("results_" + str(epsilon) + "_" + str(continuation_probability) + "_" + str(mistake_probability), 'w') as file:
+                    file.write("\n".join(lines) + "\n")
 
-                    # When we're done with all the strategies, print done, just so I know how long things are taking
-                    print("Done eps=" + str(epsilon) + " delta=" + str(continuation_probability) + " gamma=" + str(mistake_probability))
+                # When we're done with all the strategies, print done, just so I know how long things are taking
+                print("Done eps=" + str(epsilon) + " delta=" + str(continuation_probability) + " gamma=" + str(mistake_probability))
 
 if __name__ == '__main__':
     main()
@@ -16,6 +16,9 @@ batchFile=batch_file.sh
 # echo the shebang line to the batch file
 echo "#!/bin/sh" >> $batchFile
 
+# Count the jobs, so that each one is passed a different index to seed its random numbers with
+jobIndex=0
+
 # Loop over each of the values in each array, generating a pbs file for each
 # set of values
 for contProb in "${continuationProbability[@]}"
@@ -25,8 +28,9 @@ do
         # Generate the filename for the jobfile
         filename=job_$contProb\_$mistakeProb.pbs
         # Generate the job file
-        ./generate_pbs.sh $contProb $mistakeProb >> $filename
+        ./generate_pbs.sh $contProb $mistakeProb $jobIndex >> $filename
         # Add the qsub command for the job file to a batch file
         echo "qsub $filename" >> $batchFile
+        jobIndex=$((jobIndex + 1))
     done
 done
@@ -7,8 +7,10 @@
 # Define parameters which are passed in.
 delta=$1    # The continuation probability
 gamma=$2    # The mistake probability
+index=$3    # The index of the job, which seeds the random numbers
 
-# Define the template.
+# Define the template. The simulation scripts seed numpy's default_rng with a SeedSequence, which needs numpy 1.17 or
+# later and so python 3.5 or later
 cat << EOF
 #!/bin/sh
 #$ -S /bin/sh
@@ -18,7 +20,7 @@ cat << EOF
 #$ -pe smp 8
 echo "Current working directory is \`pwd\`"
 echo "Starting run "\$0" at: \`date\`"
-module load python/3.4.3
-python3 simulation.py $delta $gamma
+module load python/3.6.2
+python3 simulation.py $delta $gamma $index
 echo "Program "\$0" finished with exit code \$? at: \`date\`"
 EOF
@@ -12,6 +12,10 @@ from repeatedmistakes.calculations_multiprocessed import calculate_payoff_with_m
 from repeatedmistakes.expected_only import expected_only
 
 from time import time
+import numpy as np
+
+# The number of rounds in the simplified calculation of the series
+ROUNDS = 100000
 
 def compute_values():
     payoff_matrix = PrisonersDilemmaPayoff()
@@ -33,24 +37,30 @@ def compute_values():
     print("Time taken " + str(mult_sim_time))
 
     calc_simple_time = time()
-    calc_simple = [0., 0.]
-    no_mistake = [0., 0.]
-    one_mistake = [0., 0.]
-    two_mistakes = [0., 0.]
-    for i in range(0, 100000):
-        for k in [0, 1]:
-            no_mistake[k] = ((1 - mu) ** 2) * (payoff_matrix.CC)[k]
-            two_mistakes[k] =  (mu ** 2) * (payoff_matrix.DD)[k]
-            one_mistake[k] = (mu * (1 - mu)) * ((payoff_matrix.CD)[k] + (payoff_matrix.DC)[k])
-            calc_simple[k] += (delta ** i) * (no_mistake[k] + one_mistake[k] + two_mistakes[k])
-
-    calc_simple[0] *= (1 - delta)
-    calc_simple[1] *= (1 - delta)
+    # Every round of AllC against AllC has the same expected payoff, which only depends on how many mistakes are made
+    no_mistake = ((1 - mu) ** 2) * np.array(payoff_matrix.CC)
+    two_mistakes = (mu ** 2) * np.array(payoff_matrix.DD)
+    one_mistake = (mu * (1 - mu)) * (np.array(payoff_matrix.CD) + np.array(payoff_matrix.DC))
+    per_round = no_mistake + one_mistake + two_mistakes
+    # The sum over the first ROUNDS rounds is then a geometric series, whose sum (1 - delta ** ROUNDS)/(1 - delta) has
+    # its denominator cancelled by the (1 - delta) normalisation
+    calc_simple = per_round * (1 - delta ** ROUNDS)
     calc_simple_time = time() - calc_simple_time
 
     print("Calculated value (simplified) = " + str(calc_simple))
     print("Time taken " + str(calc_simple_time))
 
+    calc_series_time = time()
+    # As a cross check, sum the series term by term. The discount factors for every round are computed in one go, and
+    # the sum is a single dot product with the payoffs of each round
+    discounts = np.power(delta, np.arange(ROUNDS))
+    per_round_payoffs = np.tile(per_round, (ROUNDS, 1))
+    calc_series = (1 - delta) * (discounts @ per_round_payoffs)
+    calc_series_time = time() - calc_series_time
+
+    print("Calculated value (series) = " + str(calc_series))
+    print("Time taken " + str(calc_series_time))
+
     calc_naive_time = time()
     calc_naive = calculate_payoff_with_mistakes(AllC, AllC, payoff_matrix, delta, mu, 1e-5)
     calc_naive_time = time() - calc_naive_time
@@ -1,46 +1,134 @@
 """
 Test different methods of finding the expected payoff
+
+The pairs of strategies are timed one at a time in this process, so that each timing only measures the method being
+timed and not other work competing for the processors. The multiprocessed methods spread their own work over every
+processor, so running the pairs in a pool as well would leave them competing with each other, and the workers of a pool
+can't start the processes the multiprocessed methods need.
+
+The output for each pair of strategies is kept in a cache on disk, keyed on the names of the strategies, the
+parameters and a hash of the source of the modules being timed. Running this again only computes the pairs that haven't
+been done with the current code, and any change to the code times everything again. Delete the cache file to time
+everything again without changing the code.
 """
 from repeatedmistakes.tests.test_calculations import strategy_combinations
 from repeatedmistakes.repeatedgame import PrisonersDilemmaPayoff
 
+from repeatedmistakes import simulations, simulations_batched, simulations_multiprocessed, calculations, \
+    calculations_multiprocessed, strategies, repeatedgame
+from repeatedmistakes.simulations import simulate_payoff
 from repeatedmistakes.simulations_multiprocessed import simulate_payoff as mult_simulate_payoff
 from repeatedmistakes.calculations import calculate_payoff_with_mistakes
 from repeatedmistakes.calculations_multiprocessed import calculate_payoff_with_mistakes as mult_calculate_payoff
 
 from time import time
+import hashlib
+import inspect
+import shelve
 
-def compute_values():
+DELTA = 0.9
+MU = 0.0005
+EPSILON = 1e-5
+
+# The file that the output for each pair is cached in between runs
+CACHE_FILE = 'all_strategies_speed_cache'
+# The modules whose code is run by the methods being timed. A change to any of them invalidates the cache
+TIMED_MODULES = [simulations, simulations_batched, simulations_multiprocessed, calculations,
+                 calculations_multiprocessed, strategies, repeatedgame]
+
+def code_stamp():
+    """
+    Get a stamp for the version of the code being timed
+
+    Returns:
+        stamp (str): A hash of the source of every module in TIMED_MODULES
+    """
+    digest = hashlib.sha1()
+    for module in TIMED_MODULES:
+        digest.update(inspect.getsource(module).encode())
+    return digest.hexdigest()
+
+# Work the stamp out once, since the code doesn't change while this is running
+CODE_STAMP = code_stamp()
+
+def compute_pair(pair):
+    """
+    Compute the expected payoff for a single pair of strategies with each method, timing each of them
+
+    Each method is timed in its single process version, which shows the cost of the method itself, and in its
+    multiprocessed version, which shows how well it spreads over the processors.
+
+    Args:
+        pair (tuple): The two strategies to play against each other
+
+    Returns:
+        lines (list): The lines of output for this pair
+    """
     payoff_matrix = PrisonersDilemmaPayoff()
-    delta = 0.9
-    mu = 0.0005
+    lines = ["Strategy one: " + str(pair[0]),
+             "Strategy two: " + str(pair[1]),
+             ""]
+
+    sim_time = time()
+    sim = simulate_payoff(pair[0], pair[1], payoff_matrix, DELTA, mistake_probability=MU, estimator_stdev=0.2)
+    sim_time = time() - sim_time
+
+    lines.append("Simulated value = " + str(sim))
+    lines.append("Time taken " + str(sim_time))
+
+    mult_sim_time = time()
+    mult_sim = mult_simulate_payoff(pair[0], pair[1], payoff_matrix, DELTA, mistake_probability=MU, estimator_stdev=0.2)
+    mult_sim_time = time() - mult_sim_time
+
+    # Record the result as a tuple of floats so numpy doesn't change the format
+    lines.append("Multiprocessed simulated value = " + str(tuple(float(payoff) for payoff in mult_sim)))
+    lines.append("Time taken " + str(mult_sim_time))
 
-    for pair in strategy_combinations:
-        print("Strategy one: " + str(pair[0]))
-        print("Strategy two: " + str(pair[1]))
-        print()
+    calc_naive_time = time()
+    calc_naive = calculate_payoff_with_mistakes(pair[0], pair[1], payoff_matrix, DELTA, MU, EPSILON, 'naive')
+    calc_naive_time = time() - calc_naive_time
 
-        mult_sim_time = time()
-        mult_sim = mult_simulate_payoff(pair[0], pair[1], payoff_matrix, delta, mistake_probability=mu, estimator_stdev=0.2)
-        mult_sim_time = time() - mult_sim_time
+    lines.append("Calculated value (naive) = " + str(calc_naive))
+    lines.append("Time taken " + str(calc_naive_time))
 
-        print("Multiprocessed simulated value = " + str(mult_sim))
-        print("Time taken " + str(mult_sim_time))
+    mult_calc_naive_time = time()
+    mult_calc_naive = mult_calculate_payoff(pair[0], pair[1], payoff_matrix, DELTA, MU, EPSILON)
+    mult_calc_naive_time = time() - mult_calc_naive_time
 
-        calc_naive_time = time()
-        calc_naive = calculate_payoff_with_mistakes(pair[0], pair[1], payoff_matrix, delta, mu, 1e-5, 'naive')
-        calc_naive_time = time() - calc_naive_time
+    lines.append("Multiprocessed calculated value (naive) = " + str(mult_calc_naive))
+    lines.append("Time taken " + str(mult_calc_naive_time))
+    lines.append("")
 
-        print("Calculated value (naive) = " + str(calc_naive))
-        print("Time taken " + str(calc_naive_time))
+    return lines
+
+def cache_key(pair):
+    """
+    Get the key that the output for a pair of strategies is cached under
+
+    Args:
+        pair (tuple): The two strategies to play against each other
+
+    Returns:
+        key (str): The names of the strategies, the parameters they're played with and the stamp of the code
+    """
+    return ",".join([pair[0].__name__, pair[1].__name__, str(DELTA), str(MU), str(EPSILON), CODE_STAMP])
+
+def compute_values():
+    with shelve.open(CACHE_FILE) as cache:
+        # Throw away the output from older versions of the code, which will never be used again
+        for key in list(cache.keys()):
+            if not key.endswith("," + CODE_STAMP):
+                del cache[key]
 
-        mult_calc_naive_time = time()
-        mult_calc_naive = mult_calculate_payoff(pair[0], pair[1], payoff_matrix, delta, mu, 1e-5, 'naive')
-        mult_calc_naive_time = time() - mult_calc_naive_time
+        # Time each pair that isn't cached yet, one at a time so the timings don't compete with each other
+        for pair in strategy_combinations:
+            if cache_key(pair) not in cache:
+                cache[cache_key(pair)] = compute_pair(pair)
 
-        print("Multiprocessed calculated value (naive) = " + str(mult_calc_naive))
-        print("Time taken " + str(mult_calc_naive_time))
-        print()
+        # Print the output for every pair, whether it was just timed or came from the cache
+        for pair in strategy_combinations:
+            for line in cache[cache_key(pair)]:
+                print(line)
 
 if __name__ == '__main__':
-    compute_values()
\ No newline at end of file
+    compute_values()
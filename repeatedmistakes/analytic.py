@@ -0,0 +1,111 @@
+"""
+Contains functions used to compute the payoffs in the iterated prisoner's dilemma exactly, without truncating a series
+
+When both strategies are finite state machines, a game between them is a Markov chain over pairs of states, with the
+randomness coming only from mistakes. The expected discounted payoff of a Markov chain can be found by solving a single
+linear system, so there is no truncation error and no sampling error.
+"""
+import numpy as np
+from repeatedmistakes.strategies import COOPERATE, DEFECT
+
+
+def analytic_payoff(strategy_one, strategy_two, payoff_matrix, continuation_probability, mistake_probability=0.):
+    """
+    Calculate the normalised payoff for strategies in the iterated prisoner's dilemma with mistakes exactly
+
+    The state of the game is the pair of states the two strategies are in. In each state each player plays their
+    intended move, or the opposite move with the mistake probability, which gives the expected payoff of the round and
+    the probabilities of moving to each state for the next round. With P the transition matrix and r the vector of
+    expected payoffs of a round in each state, the expected total payoff from each state is
+
+        v = r + delta P r + delta^2 P^2 r + ... = (I - delta P)^-1 r
+
+    and the normalised payoff is (1 - delta) times the value in the initial state.
+
+    Args:
+        strategy_one (Strategy): The first strategy in the game
+        strategy_two (Strategy): The second strategy in the game
+        payoff_matrix (PayoffMatrix): An object that gives the payoff for each player given certain actions
+        continuation_probability (float): The probability that another game is played after each round
+        mistake_probability (float): The probability of a single strategy making a mistake in a single round
+
+    Returns:
+        strategy_one_payoff, strategy_two_payoff (float): The normalised payoff result
+
+    Raises:
+        ValueError: If the continuation probability is greater than or equal to 1 or less than zero
+        ValueError: If the mistake_probability is greater than or equal to 1 or less than zero
+        NotImplementedError: If either strategy can't be written as a state machine
+    """
+    # Validate some input
+    if continuation_probability >= 1 or continuation_probability < 0:
+        raise ValueError('Continuation probability must less than 1 (for convergence) and greater than or equal to zero')
+
+    if mistake_probability >= 1 or mistake_probability < 0:
+        raise ValueError('Mistake probability must be a valid probability ie. in the range [0, 1]')
+
+    initial_state, transition_matrix, expected_payoffs = markov_chain(strategy_one, strategy_two, payoff_matrix,
+                                                                      mistake_probability)
+
+    values = np.linalg.solve(np.eye(len(transition_matrix)) - continuation_probability * transition_matrix,
+                             expected_payoffs)
+
+    # Multiply by (1 - continuation_probability) to normalise the value
+    strategy_one_payoff, strategy_two_payoff = values[initial_state] * (1 - continuation_probability)
+
+    return float(strategy_one_payoff), float(strategy_two_payoff)
+
+
+def markov_chain(strategy_one, strategy_two, payoff_matrix, mistake_probability=0.):
+    """
+    Build the Markov chain of a game between two strategies written as state machines
+
+    The state of the game is the pair of states the two strategies are in, with the pair (state_one, state_two)
+    numbered state_one * number of states of strategy_two + state_two.
+
+    Args:
+        strategy_one (Strategy): The first strategy in the game
+        strategy_two (Strategy): The second strategy in the game
+        payoff_matrix (PayoffMatrix): An object that gives the payoff for each player given certain actions
+        mistake_probability (float): The probability of a single strategy making a mistake in a single round
+
+    Returns:
+        initial_state (int): The state of the game in the first round
+        transition_matrix (np.ndarray): The probability of moving from each state of the game to each other state
+        expected_payoffs (np.ndarray): The expected payoffs of both players for a round played in each state, with
+            shape (number of states, 2)
+
+    Raises:
+        NotImplementedError: If either strategy can't be written as a state machine
+    """
+    machine_one = strategy_one(C=COOPERATE, D=DEFECT).state_machine()
+    machine_two = strategy_two(C=COOPERATE, D=DEFECT).state_machine()
+    states_one = len(machine_one.moves)
+    states_two = len(machine_two.moves)
+
+    # The pair of states (state_one, state_two) is numbered state_one * states_two + state_two
+    number_of_states = states_one * states_two
+    transition_matrix = np.zeros((number_of_states, number_of_states))
+    expected_payoffs = np.zeros((number_of_states, 2))
+
+    for state_one in range(states_one):
+        for state_two in range(states_two):
+            state = state_one * states_two + state_two
+            # Consider every pair of moves that could actually be played, given the moves the players meant to play
+            for move_one in (COOPERATE, DEFECT):
+                for move_two in (COOPERATE, DEFECT):
+                    probability = 1.
+                    probability *= (1 - mistake_probability) if move_one == machine_one.moves[state_one] \
+                        else mistake_probability
+                    probability *= (1 - mistake_probability) if move_two == machine_two.moves[state_two] \
+                        else mistake_probability
+
+                    expected_payoffs[state] += probability * payoff_matrix.table[move_one, move_two]
+
+                    next_state_one = machine_one.transitions[state_one][move_one][move_two]
+                    next_state_two = machine_two.transitions[state_two][move_two][move_one]
+                    transition_matrix[state, next_state_one * states_two + next_state_two] += probability
+
+    initial_state = machine_one.initial_state * states_two + machine_two.initial_state
+
+    return initial_state, transition_matrix, expected_payoffs
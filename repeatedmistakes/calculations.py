@@ -2,10 +2,11 @@
 Contains functions that allow for the analysis of different strategies or combinations of strategies and for performing
 computations.
 """
-from queue import Queue
-from collections import namedtuple
-from scipy.optimize import broyden1
+from functools import lru_cache
+import numpy as np
 import math
+from repeatedmistakes.analytic import analytic_payoff, markov_chain
+from repeatedmistakes.strategies import COOPERATE, DEFECT
 
 def calculate_payoff(strategy_one, strategy_two, payoff_matrix, continuation_probability, epsilon):
     """
@@ -33,48 +34,149 @@ def calculate_payoff(strategy_one, strategy_two, payoff_matrix, continuation_pro
     if continuation_probability >= 1 or continuation_probability < 0:
         raise ValueError('Continuation probability must be less than 1 for the sum to converge')
 
-    strategy_one_payoff = 0.
-    strategy_two_payoff = 0.
+    # Work out up front how many rounds we need before the terms get small enough to truncate the series
+    rounds = truncation_rounds(continuation_probability, payoff_matrix.max(), epsilon)
+
+    try:
+        machine_one = cached_player(strategy_one, COOPERATE, DEFECT).state_machine()
+        machine_two = cached_player(strategy_two, COOPERATE, DEFECT).state_machine()
+    except NotImplementedError:
+        payoffs = history_payoffs(strategy_one, strategy_two, payoff_matrix, rounds)
+    else:
+        # Both strategies are state machines, so the moves are just table lookups and the payoffs of every round can be
+        # looked up at once
+        moves_one, moves_two = machine_moves(machine_one, machine_two, rounds)
+        payoffs = payoff_matrix.table[moves_one, moves_two]
+
+    # The series is then the dot product of the payoffs with the powers of the continuation probability, which gives the
+    # totals for both players at once. Multiply by (1 - continuation_probability) to normalise the value
+    weights = np.power(continuation_probability, np.arange(rounds))
+    totals = (weights @ payoffs) * (1 - continuation_probability)
+
+    return float(totals[0]), float(totals[1])
+
+
+def machine_moves(machine_one, machine_two, rounds):
+    """
+    Play two state machines against each other without mistakes and return the moves they make
+
+    Without mistakes the game is deterministic, so as soon as the pair of states repeats the game goes round the same
+    cycle forever. We only step the machines until that happens, and fill in the rest of the moves by repeating the
+    cycle with numpy. There are only as many rounds to step as there are pairs of states, however long the game is.
 
+    Args:
+        machine_one (StateMachine): The state machine of the first strategy, using COOPERATE and DEFECT
+        machine_two (StateMachine): The state machine of the second strategy, using COOPERATE and DEFECT
+        rounds (int): The number of rounds to play
+
+    Returns:
+        moves_one, moves_two (np.ndarray): The moves of each strategy in each round
+    """
+    moves_one = np.empty(rounds, dtype=np.intp)
+    moves_two = np.empty(rounds, dtype=np.intp)
+    # The round in which each pair of states was first seen
+    first_seen = {}
+    state_one = machine_one.initial_state
+    state_two = machine_two.initial_state
+    for round_index in range(rounds):
+        if (state_one, state_two) in first_seen:
+            # Repeat the cycle from where this pair of states was first seen to fill in the rest of the game
+            cycle_start = first_seen[state_one, state_two]
+            cycle_length = round_index - cycle_start
+            cycle_index = cycle_start + np.arange(rounds - round_index) % cycle_length
+            moves_one[round_index:] = moves_one[cycle_index]
+            moves_two[round_index:] = moves_two[cycle_index]
+            break
+        first_seen[state_one, state_two] = round_index
+
+        move_one = machine_one.moves[state_one]
+        move_two = machine_two.moves[state_two]
+        moves_one[round_index] = move_one
+        moves_two[round_index] = move_two
+        state_one = machine_one.transitions[state_one][move_one][move_two]
+        state_two = machine_two.transitions[state_two][move_two][move_one]
+    return moves_one, moves_two
+
+
+def history_payoffs(strategy_one, strategy_two, payoff_matrix, rounds):
+    """
+    Play two strategies against each other without mistakes, asking them for their moves given the histories
+
+    Args:
+        strategy_one (Strategy): The first strategy in the game
+        strategy_two (Strategy): The other strategy in the game
+        payoff_matrix (PayoffMatrix): An object that gives the payoff for each player given certain actions
+        rounds (int): The number of rounds to play
+
+    Returns:
+        payoffs (np.ndarray): The payoffs of both players in each round, with shape (rounds, 2)
+    """
     # Create the player objects using the characterset from the payoff matrix
     player_one = strategy_one(C=payoff_matrix.C, D=payoff_matrix.D)
     player_two = strategy_two(C=payoff_matrix.C, D=payoff_matrix.D)
 
-    max_term_size = float('inf')
-
-    # Set the rounds coutner to -1 so that the first round will be round 0
-    rounds = -1
-    while max_term_size > epsilon:
-        rounds += 1
+    # Play the rounds, recording the payoff of each player in each round
+    payoffs = np.empty((rounds, 2))
+    for round_index in range(rounds):
         # Compute the moves that each strategy makes
-        move_one = player_one.next_move(player_two.history)
-        move_two = player_two.next_move(player_one.history)
+        move_one = player_one.next_move(player_two.history, validate=False)
+        move_two = player_two.next_move(player_one.history, validate=False)
         # Add these moves to each history
-        player_one.history += move_one
-        player_two.history += move_two
+        player_one.observe(move_one, move_two)
+        player_two.observe(move_two, move_one)
         # Get the payoff resulting from the last game
-        player_one_payoff, player_two_payoff = payoff_matrix.payoff(player_one=move_one, player_two=move_two)
-        # Compute the term from the sum
-        player_one_term = (continuation_probability ** rounds) * player_one_payoff
-        player_two_term = (continuation_probability ** rounds) * player_two_payoff
-        strategy_one_payoff += player_one_term
-        strategy_two_payoff += player_two_term
+        payoffs[round_index] = payoff_matrix.payoff(move_one, move_two)
+    return payoffs
 
-        # Compute the max term size
-        max_term_size = (continuation_probability ** rounds) * payoff_matrix.max()
 
+def truncation_rounds(continuation_probability, max_payoff, epsilon):
+    """
+    Compute the number of rounds that need to be summed before the series for the normalised payoff is truncated
 
-    # Multiply by (1 - continuation_probability) to normalise the value
-    strategy_one_payoff *= (1 - continuation_probability)
-    strategy_two_payoff *= (1 - continuation_probability)
+    The series is truncated after the first round r where the largest possible term, continuation_probability ** r
+    times the largest payoff, is no more than epsilon. We estimate r with logarithms and then correct it against that
+    same test, so that rounding in the logarithms can't change where the series stops.
+
+    This also bounds the error from truncating. Every term after the last round r is at most max_payoff times a power of
+    the continuation probability, so the normalised tail is at most
+    (1 - continuation_probability) * max_payoff * sum(continuation_probability ** n for n > r)
+    = continuation_probability ** (r + 1) * max_payoff <= continuation_probability * epsilon, which is less than epsilon.
+
+    Args:
+        continuation_probability (float): The probability that another game is played after each round
+        max_payoff (float): The largest payoff possible in a single round
+        epsilon (float): The minimum possible size of a term before the series is truncated
+
+    Returns:
+        rounds (int): The number of rounds in the truncated series, including the round where it is truncated
+    """
+    if max_payoff <= epsilon:
+        return 1
+    if continuation_probability == 0:
+        return 2
+
+    last_round = max(0, math.ceil(math.log(epsilon / max_payoff) / math.log(continuation_probability)))
+    while last_round > 0 and (continuation_probability ** (last_round - 1)) * max_payoff <= epsilon:
+        last_round -= 1
+    while (continuation_probability ** last_round) * max_payoff > epsilon:
+        last_round += 1
+
+    return last_round + 1
 
-    return strategy_one_payoff, strategy_two_payoff
 
 def calculate_payoff_with_mistakes(strategy_one, strategy_two, payoff_matrix, continuation_probability,
-                                  mistake_probability, epsilon):
+                                  mistake_probability, epsilon, method='naive'):
     """
     Calculate the normalised payoff for strategies in the iterated prisoner's dilemma with mistakes
 
+    The calculation is done by one of the methods in calc_methods:
+        * naive: Expand the tree of every possible sequence of mistakes, truncating the branches once their largest
+            possible term is below epsilon
+        * markov: Solve the Markov chain of the two strategies' state machines exactly, which doesn't depend on epsilon
+            at all. Strategies that can't be written as a state machine fall back to the naive method.
+        * forward: Follow the distribution over the states of the Markov chain round by round, truncating the series
+            once the largest possible term of a round is below epsilon. This also falls back to the naive method.
+
     Args:
         strategy_one (Strategy): The first strategy in the game
         strategy_two (Strategy): The second strategy in the game
@@ -83,6 +185,7 @@ def calculate_payoff_with_mistakes(strategy_one, strategy_two, payoff_matrix, co
         mistake_probability (float): The probability of a single strategy making a mistake in a single round
         epsilon (float): The value at which we truncate the series. We truncate when the largest possible term is lower
             than this value
+        method (str): The name of the method in calc_methods to use. Defaults to 'naive'.
 
     Returns:
         strategy_one_payoff, strategy_two_payoff (float): The normalised payoff result
@@ -90,6 +193,7 @@ def calculate_payoff_with_mistakes(strategy_one, strategy_two, payoff_matrix, co
     Raises:
         ValueError: If the continuation probability is greater than or equal to 1 or less than zero
         ValueError: If the mistake_probability is greater than or equal to 1 or less than zero
+        ValueError: If the method is not one of the methods in calc_methods
     """
     # Validate some input
     if continuation_probability >= 1 or continuation_probability < 0:
@@ -98,95 +202,334 @@ def calculate_payoff_with_mistakes(strategy_one, strategy_two, payoff_matrix, co
     if mistake_probability >= 1 or mistake_probability < 0:
         raise ValueError('Mistake probability must be a valid probability ie. in the range [0, 1]')
 
-    # This queue will hold the terms that need to be computed
-    q = Queue()
+    if method not in calc_methods:
+        raise ValueError('Method must be one of ' + ', '.join(sorted(calc_methods)))
+
+    return calc_methods[method](strategy_one, strategy_two, payoff_matrix, continuation_probability,
+                                mistake_probability, epsilon)
+
+
+def naive_method(strategy_one, strategy_two, payoff_matrix, continuation_probability, mistake_probability, epsilon):
+    """
+    Calculate the normalised payoff with mistakes by expanding the tree of every possible sequence of mistakes
+
+    Each node of the tree is the state of the game along with the probability of reaching it. We expand every node,
+    and stop expanding a branch once the largest possible term from it is below epsilon.
+    When both strategies can be written as state machines the state of the game is just the pair of machine states, and
+    the tree is expanded a whole round at a time with numpy. Otherwise the state is the pair of histories.
+
+    Args:
+        As per calculate_payoff_with_mistakes
+
+    Returns:
+        strategy_one_payoff, strategy_two_payoff (float): The normalised payoff result
+    """
+    try:
+        machine_one = cached_player(strategy_one, COOPERATE, DEFECT).state_machine()
+        machine_two = cached_player(strategy_two, COOPERATE, DEFECT).state_machine()
+    except NotImplementedError:
+        return expand_history_tree(strategy_one, strategy_two, payoff_matrix, continuation_probability,
+                                   mistake_probability, epsilon)
+
+    return expand_state_tree(machine_one, machine_two, payoff_matrix, continuation_probability, mistake_probability,
+                             epsilon)
 
-    # Set up a namedtuple to structure the data on our queue
-    Node = namedtuple('Node',['coefficient', 'history', 'mistakes'])
 
-    # We initialise the queue with an empty history and a term of 1 which of course has zero mistakes
-    q.put(Node(coefficient=1, history=('', ''), mistakes=0))
+def expand_state_tree(machine_one, machine_two, payoff_matrix, continuation_probability, mistake_probability, epsilon):
+    """
+    Expand the tree of every possible sequence of mistakes for two strategies written as state machines
+
+    The nodes in each round are held as arrays of coefficients and the states of both machines, so each round of the
+    tree takes a handful of array operations no matter how many nodes it has. The nodes are expanded in the same way,
+    and truncated by the same test, as in expand_history_tree.
+
+    The coefficient of a node only depends on its round and how many mistakes were made to reach it, and what happens
+    after it only depends on the states of the machines. So nodes in the same round with the same states and number of
+    mistakes have identical subtrees, and we merge them into a single node that counts how many paths reach it. The
+    truncation test still uses the coefficient of a single path, so exactly the same terms are summed as if every path
+    were expanded separately, but the number of nodes in a round grows with the number of mistakes rather than
+    exponentially.
+
+    Args:
+        machine_one (StateMachine): The state machine of the first strategy, using COOPERATE and DEFECT
+        machine_two (StateMachine): The state machine of the second strategy, using COOPERATE and DEFECT
+        The rest as per calculate_payoff_with_mistakes
+
+    Returns:
+        strategy_one_payoff, strategy_two_payoff (float): The normalised payoff result
+    """
+    moves_one = np.array(machine_one.moves, dtype=np.intp)
+    moves_two = np.array(machine_two.moves, dtype=np.intp)
+    transitions_one = np.array(machine_one.transitions, dtype=np.intp)
+    transitions_two = np.array(machine_two.transitions, dtype=np.intp)
+    max_payoff = payoff_matrix.max()
+
+    # Whether each player makes a mistake in a round, and the probability of that happening
+    outcomes = [(0, 0, (1 - mistake_probability) ** 2),
+                (1, 0, mistake_probability * (1 - mistake_probability)),
+                (0, 1, mistake_probability * (1 - mistake_probability)),
+                (1, 1, mistake_probability ** 2)]
+
+    # We start with a single node for the first round with a coefficient of 1, reached by a single path with no mistakes
+    coefficients = np.ones(1)
+    paths = np.ones(1)
+    mistakes = np.zeros(1, dtype=np.intp)
+    states_one = np.array([machine_one.initial_state], dtype=np.intp)
+    states_two = np.array([machine_two.initial_state], dtype=np.intp)
+
+    payoffs = np.zeros(2)
+
+    while len(coefficients) > 0:
+        move_one = moves_one[states_one]
+        move_two = moves_two[states_two]
+
+        children = [[] for _ in range(5)]
+        for mistake_one, mistake_two, probability in outcomes:
+            played_one = move_one ^ mistake_one
+            played_two = move_two ^ mistake_two
+
+            # Add the payoffs of this outcome from every path through every node
+            payoffs += (probability * coefficients * paths) @ payoff_matrix.table[played_one, played_two]
+
+            # Keep the children whose largest possible term is large enough
+            child_coefficients = continuation_probability * probability * coefficients
+            keep = child_coefficients * max_payoff > epsilon
+            played_one = played_one[keep]
+            played_two = played_two[keep]
+            for child, values in zip(children, (child_coefficients[keep], paths[keep],
+                                                mistakes[keep] + mistake_one + mistake_two,
+                                                transitions_one[states_one[keep], played_one, played_two],
+                                                transitions_two[states_two[keep], played_two, played_one])):
+                child.append(values)
+
+        coefficients, paths, mistakes, states_one, states_two = [np.concatenate(child) for child in children]
+
+        # Merge the nodes with the same states and number of mistakes, adding up the number of paths to them
+        nodes, first, merged = np.unique(np.stack([states_one, states_two, mistakes]), axis=1, return_index=True,
+                                         return_inverse=True)
+        states_one, states_two, mistakes = nodes
+        coefficients = coefficients[first]
+        paths = np.bincount(merged.ravel(), weights=paths, minlength=len(first))
+
+    # Normalise by multiplying by 1 - continuation_probability
+    strategy_one_payoff, strategy_two_payoff = payoffs * (1 - continuation_probability)
+
+    return float(strategy_one_payoff), float(strategy_two_payoff)
+
+
+def expand_history_tree(strategy_one, strategy_two, payoff_matrix, continuation_probability, mistake_probability,
+                        epsilon):
+    """
+    Expand the tree of every possible sequence of mistakes, keeping the histories of the game in each node
+
+    This works for any strategy, as the strategies are asked for their moves given each history. The nodes are kept on
+    a stack and expanded depth first, so only the nodes along the current branch and their siblings are held at once
+    rather than the whole of the widest round of the tree.
+
+    Args:
+        As per calculate_payoff_with_mistakes
+
+    Returns:
+        strategy_one_payoff, strategy_two_payoff (float): The normalised payoff result
+    """
+    # This stack will hold the terms that need to be computed
+    q = []
+
+    # Each node on the stack is a plain tuple of (coefficient, bits_one, bits_two, length, mistakes), which is cheaper to
+    # build and unpack than a namedtuple. Each history is packed into an integer with bit i set if the move in round i
+    # was a defection, and both have the same length. Appending a move is then a single bitwise or, rather than copying
+    # the whole history like appending to a string does.
+
+    # We initialise the stack with an empty history and a term of 1 which of course has zero mistakes
+    q.append((1, 0, 0, 0, 0))
 
     # Set up the values we're going to return
     strategy_one_payoff = 0.
     strategy_two_payoff = 0.
 
-    # Set up the strategy objects we wish to use. Use the charset from the payoff matrix
-    player_one = strategy_one(C=payoff_matrix.C, D=payoff_matrix.D)
-    player_two = strategy_two(C=payoff_matrix.C, D=payoff_matrix.D)
-
-    while not q.empty():
-        # Get the first item in the queue
-        node = q.get()
-
-        # Process the no-mistake case
-        # Unpack the histories
-        player_one.history, player_two.history = node.history
-
-        # Get the next moves
-        player_one_move = player_one.next_move(player_two.history)
-        player_two_move = player_two.next_move(player_one.history)
-
-        # Compute the payoff and add it to the total
-        payoff = payoff_matrix.payoff(player_one_move, player_two_move)
-        strategy_one_payoff += payoff[0] * ((1 - mistake_probability) ** 2) * node.coefficient
-        strategy_two_payoff += payoff[1] * ((1 - mistake_probability) ** 2) * node.coefficient
-
-        # Add an item to the queue, if the max term size is large enough
-        coefficient = continuation_probability * ((1 - mistake_probability) ** 2) * node.coefficient
-        if coefficient * payoff_matrix.max() > epsilon:
-            q.put(Node(coefficient=coefficient, history=[player_one.history + player_one_move,
-                                                         player_two.history + player_two_move], mistakes=node.mistakes))
-
-        # Figure out the case for one mistake
-        # Compute the payoff
-        # Make one mistake
-        player_one_move = player_one.opposite(player_one_move)
-        payoff = payoff_matrix.payoff(player_one_move, player_two_move)
-        strategy_one_payoff += payoff[0] * (mistake_probability * (1 - mistake_probability)) * node.coefficient
-        strategy_two_payoff += payoff[1] * (mistake_probability * (1 - mistake_probability)) * node.coefficient
-
-        # Add to the queue if max term size is large enough
-        coefficient = continuation_probability * (mistake_probability * (1 - mistake_probability)) * node.coefficient
-        if coefficient * payoff_matrix.max() > epsilon:
-            q.put(Node(coefficient=coefficient,
-                       history=[player_one.history + player_one_move,
-                                player_two.history + player_two_move],
-                       mistakes=node.mistakes + 1))
-
-        # Now the other one mistake case
-        # Reverse the mistake we just made
-        player_one_move = player_one.opposite(player_one_move)
-        # Make another mistake
-        player_two_move = player_two.opposite(player_two_move)
-        payoff = payoff_matrix.payoff(player_one_move, player_two_move)
-        strategy_one_payoff += payoff[0] * (mistake_probability * (1 - mistake_probability)) * node.coefficient
-        strategy_two_payoff += payoff[1] * (mistake_probability * (1 - mistake_probability)) * node.coefficient
-
-        # Add to the queue if the max term size is large enough
-        coefficient = continuation_probability * (mistake_probability * (1 - mistake_probability)) * node.coefficient
-        if coefficient * payoff_matrix.max() > epsilon:
-            q.put(Node(coefficient=coefficient,
-                       history=[player_one.history + player_one_move,
-                                player_two.history + player_two_move],
-                       mistakes=node.mistakes + 1))
-        # Lastly the two mistake case
-        # Make another mistake for a total of two (the second player has already made a mistake)
-        player_one_move = player_one.opposite(player_one_move)
-        payoff = payoff_matrix.payoff(player_one_move, player_two_move)
-        strategy_one_payoff += payoff[0] * (mistake_probability ** 2) * node.coefficient
-        strategy_two_payoff += payoff[1] * (mistake_probability ** 2) * node.coefficient
-
-        # Add to the queue if the max term size is large enough
-        coefficient = continuation_probability * (mistake_probability ** 2) * node.coefficient
-        if coefficient * payoff_matrix.max() > epsilon:
-            q.put(Node(coefficient=coefficient,
-                       history=[player_one.history + player_one_move,
-                                player_two.history + player_two_move],
-                       mistakes=node.mistakes + 2))
+    # Work out everything that doesn't change between nodes once, rather than for every node. The payoffs of each pair
+    # of moves, the opposite of each move and the bit each move packs into are kept in local dicts so that the loop
+    # doesn't go through attribute lookups and method calls to get them
+    C, D = payoff_matrix.C, payoff_matrix.D
+    payoffs = {(move_one, move_two): payoff_matrix.payoff(move_one, move_two)
+               for move_one in (C, D) for move_two in (C, D)}
+    opposite = {C: D, D: C}
+    move_bit = {C: 0, D: 1}
+    push = q.append
+    max_payoff = payoff_matrix.max()
+    no_mistake_weight = (1 - mistake_probability) ** 2
+    one_mistake_weight = mistake_probability * (1 - mistake_probability)
+    two_mistake_weight = mistake_probability ** 2
+
+    # Whether each player makes a mistake in a round, the probability of that happening, and the probability of that
+    # happening and the game continuing
+    outcomes = [(0, 0, no_mistake_weight, continuation_probability * no_mistake_weight),
+                (1, 0, one_mistake_weight, continuation_probability * one_mistake_weight),
+                (0, 1, one_mistake_weight, continuation_probability * one_mistake_weight),
+                (1, 1, two_mistake_weight, continuation_probability * two_mistake_weight)]
+
+    while q:
+        # Get the last item on the stack
+        node_coefficient, bits_one, bits_two, length, node_mistakes = q.pop()
+
+        # Get the next moves, and the moves that would be played instead if there was a mistake
+        player_one_move = cached_next_move(strategy_one, C, D, bits_one, bits_two, length)
+        player_two_move = cached_next_move(strategy_two, C, D, bits_two, bits_one, length)
+        player_one_moves = (player_one_move, opposite[player_one_move])
+        player_two_moves = (player_two_move, opposite[player_two_move])
+
+        for mistake_one, mistake_two, weight, continuation_weight in outcomes:
+            player_one_move = player_one_moves[mistake_one]
+            player_two_move = player_two_moves[mistake_two]
+
+            # Compute the payoff and add it to the total
+            payoff = payoffs[player_one_move, player_two_move]
+            strategy_one_payoff += payoff[0] * weight * node_coefficient
+            strategy_two_payoff += payoff[1] * weight * node_coefficient
+
+            # Add an item to the stack, if the max term size is large enough
+            coefficient = continuation_weight * node_coefficient
+            if coefficient * max_payoff > epsilon:
+                push((coefficient,
+                      bits_one | (move_bit[player_one_move] << length),
+                      bits_two | (move_bit[player_two_move] << length),
+                      length + 1,
+                      node_mistakes + mistake_one + mistake_two))
 
     # Normalise by multiplying by 1 - continuation_probability
     strategy_one_payoff *= (1 - continuation_probability)
     strategy_two_payoff *= (1 - continuation_probability)
 
     return strategy_one_payoff, strategy_two_payoff
+
+
+def unpack_history(bits, length, C, D):
+    """
+    Unpack a history that was packed into an integer by expand_history_tree back into a list of moves
+
+    Args:
+        bits (int): The packed history
+        length (int): The number of rounds in the history
+        C (string): The symbol used to represent cooperation
+        D (string): The symbol used to represent defection
+
+    Returns:
+        history (list): The moves in the history, in the order they were played
+    """
+    return [D if (bits >> round_index) & 1 else C for round_index in range(length)]
+
+
+@lru_cache(maxsize=None)
+def cached_player(strategy, C, D):
+    """
+    Get an instance of a strategy with the given characterset, creating it only the first time it's asked for
+
+    The same instance is handed to every caller in the process, so it is only safe to use from a single thread, and
+    callers must not rely on its history surviving between uses. It is used in two ways:
+        * To get the strategy's state machine, which doesn't read or change the history
+        * To get a single move in cached_next_move, which sets both histories immediately before asking for the move
+    Anything that plays a game round by round, or needs both players to keep separate histories when they are the same
+    strategy, creates its own instances instead, as calculate_payoff does in history_payoffs.
+
+    Args:
+        strategy (Strategy): The strategy to get an instance of
+        C (string): The symbol used to represent cooperation
+        D (string): The symbol used to represent defection
+
+    Returns:
+        player (Strategy): The shared instance of the strategy
+    """
+    return strategy(C=C, D=D)
+
+
+@lru_cache(maxsize=2 ** 16)
+def cached_next_move(strategy, C, D, own_bits, opponent_bits, length):
+    """
+    Get the next move of a strategy given the packed histories of a game, remembering the most recent results
+
+    Every node in a single tree has a different pair of histories, but the trees for the same pair of strategies with
+    different parameters share all of their early rounds. A batch job that sweeps over the parameters for each pair of
+    strategies therefore only asks the strategy for each of those moves once.
+
+    Args:
+        strategy (Strategy): The strategy to get the move of
+        C (string): The symbol used to represent cooperation
+        D (string): The symbol used to represent defection
+        own_bits (int): The strategy's own history, packed as described in expand_history_tree
+        opponent_bits (int): The opponent's history, packed as described in expand_history_tree
+        length (int): The number of rounds in the histories
+
+    Returns:
+        move (string): The next move of the strategy
+    """
+    player = cached_player(strategy, C, D)
+    player.history = unpack_history(own_bits, length, C, D)
+    return player.next_move(unpack_history(opponent_bits, length, C, D), validate=False)
+
+
+def markov_method(strategy_one, strategy_two, payoff_matrix, continuation_probability, mistake_probability, epsilon):
+    """
+    Calculate the normalised payoff with mistakes exactly, by solving the Markov chain of the strategies' state machines
+
+    For memory-one strategies the game is a chain over the four outcomes of the last round, plus the first round, and
+    strategies with more memory like Grim and TFNT just add states. See analytic.analytic_payoff. The result has no
+    truncation error, so epsilon is only used if we have to fall back to the naive method.
+
+    Args:
+        As per calculate_payoff_with_mistakes
+
+    Returns:
+        strategy_one_payoff, strategy_two_payoff (float): The normalised payoff result
+    """
+    try:
+        return analytic_payoff(strategy_one, strategy_two, payoff_matrix, continuation_probability, mistake_probability)
+    except NotImplementedError:
+        # One of the strategies can't be written as a state machine, so expand the tree instead
+        return naive_method(strategy_one, strategy_two, payoff_matrix, continuation_probability, mistake_probability,
+                            epsilon)
+
+
+def forward_method(strategy_one, strategy_two, payoff_matrix, continuation_probability, mistake_probability, epsilon):
+    """
+    Calculate the normalised payoff with mistakes by following the distribution of the game's state round by round
+
+    Every branch of the naive tree that leads to the same pair of states plays the same from then on, so rather than
+    expanding the branches separately we keep the probability of the game being in each pair of states. Each round the
+    expected payoff is added and the distribution is stepped forward by the transition matrix of the game, which is the
+    Kronecker product of both players' mistake kernels applied to their intended moves. This takes a fixed amount of
+    work per round rather than four times as much as the last, and the series is truncated at the same round as it
+    would be without mistakes in calculate_payoff. Strategies that can't be written as a state machine fall back to the
+    naive method.
+
+    Args:
+        As per calculate_payoff_with_mistakes
+
+    Returns:
+        strategy_one_payoff, strategy_two_payoff (float): The normalised payoff result
+    """
+    try:
+        initial_state, transition_matrix, expected_payoffs = markov_chain(strategy_one, strategy_two, payoff_matrix,
+                                                                          mistake_probability)
+    except NotImplementedError:
+        return naive_method(strategy_one, strategy_two, payoff_matrix, continuation_probability, mistake_probability,
+                            epsilon)
+
+    rounds = truncation_rounds(continuation_probability, payoff_matrix.max(), epsilon)
+
+    # The probability of the game being in each state in the current round, times the discount for the round
+    distribution = np.zeros(len(transition_matrix))
+    distribution[initial_state] = 1.
+
+    payoffs = np.zeros(2)
+    for _ in range(rounds):
+        payoffs += distribution @ expected_payoffs
+        distribution = continuation_probability * (distribution @ transition_matrix)
+
+    # Normalise by multiplying by 1 - continuation_probability
+    strategy_one_payoff, strategy_two_payoff = payoffs * (1 - continuation_probability)
+
+    return float(strategy_one_payoff), float(strategy_two_payoff)
+
+
+# The methods that calculate_payoff_with_mistakes can use, by name
+calc_methods = {'naive': naive_method, 'markov': markov_method, 'forward': forward_method}
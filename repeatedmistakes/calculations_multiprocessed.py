@@ -2,19 +2,42 @@
 Contains functions that allow for the analysis of different strategies or combinations of strategies and for performing
 computations, utilising multiprocessing for speed improvements.
 """
-from multiprocessing import Manager, cpu_count, Process
+from multiprocessing import Pool, cpu_count
+import atexit
 from functools import partial
-import queue
 from collections import namedtuple
-
-# Set up a namedtuple to structure the data on our queue
-Node = namedtuple('Node',['coefficient', 'history'])
+from math import fsum, comb
+from repeatedmistakes.calculations import cached_next_move
+
+# Set up a namedtuple to structure the nodes of the tree. The histories of both players are packed into integers with
+# bit i set if the move in round i was a defection, as in calculations.expand_history_tree, and both have the same
+# length. These are much smaller to send between processes than strings, and appending a move doesn't copy the whole
+# history
+Node = namedtuple('Node',['coefficient', 'bits_one', 'bits_two', 'length'])
+
+# The number of rounds of the tree that are expanded in the parent process before the subtrees below them are handed out
+# to the workers. This gives up to 4 ** FRONTIER_DEPTH subtrees, which is plenty to keep every process busy while
+# being cheap to expand
+FRONTIER_DEPTH = 4
+# The number of subtrees sent to a worker at once
+SUBTREE_CHUNKSIZE = 8
+# Trees with fewer nodes than this are expanded in the calling process, since starting the pool would take longer than
+# expanding the whole tree
+SERIAL_NODE_LIMIT = 20000
+
+# The pool of worker processes, which is started the first time it's needed and then kept for later calls
+pool = None
 
 def calculate_payoff_with_mistakes(strategy_one, strategy_two, payoff_matrix, continuation_probability,
                                   mistake_probability, epsilon):
     """
     Calculate the normalised payoff for strategies in the iterated prisoner's dilemma with mistakes
 
+    The parent process expands the first FRONTIER_DEPTH rounds of the tree, and the subtrees below them are spread over
+    a pool of processes which each expand their subtrees to the end and send back the total payoffs. Nothing else is
+    passed between the processes, so there is no shared queue for the workers to wait on. If the tree has fewer than
+    SERIAL_NODE_LIMIT nodes it is all expanded in the calling process instead, without starting the pool.
+
     Args:
         strategy_one (Strategy): The first strategy in the game
         strategy_two (Strategy): The second strategy in the game
@@ -30,7 +53,6 @@ def calculate_payoff_with_mistakes(strategy_one, strategy_two, payoff_matrix, co
     Raises:
         ValueError: If the continuation probability is greater than or equal to 1 or less than zero
         ValueError: If the mistake_probability is greater than or equal to 1 or less than zero
-        ValueError: If the calc_method is not one of the valid ones
     """
     # Validate some input
     if continuation_probability >= 1 or continuation_probability < 0:
@@ -39,184 +61,189 @@ def calculate_payoff_with_mistakes(strategy_one, strategy_two, payoff_matrix, co
     if mistake_probability >= 1 or mistake_probability < 0:
         raise ValueError('Mistake probability must be a valid probability ie. in the range [0, 1]')
 
-    # This queue will hold the terms that need to be computed and the results returned from the processes.
-    m = Manager()
-    nodeq = m.Queue()
-    resultq = m.Queue()
+    # Set up a partial function for expanding subtrees, since everything but the roots is the same for every subtree
+    subtree_partial = partial(expand_subtree,
+                              strategy_one=strategy_one,
+                              strategy_two=strategy_two,
+                              payoff_matrix=payoff_matrix,
+                              continuation_probability=continuation_probability,
+                              mistake_probability=mistake_probability,
+                              epsilon=epsilon)
+
+    # Expand the top of the tree here, starting with an empty history and a term of 1, and keep the nodes at the
+    # frontier to hand out to the workers. If the tree is small enough, just expand all of it here
+    root = Node(coefficient=1, bits_one=0, bits_two=0, length=0)
+    if tree_size(continuation_probability, mistake_probability, payoff_matrix.max(), epsilon,
+                 SERIAL_NODE_LIMIT) < SERIAL_NODE_LIMIT:
+        depth_limit = None
+    else:
+        depth_limit = FRONTIER_DEPTH
+    strategy_one_payoff, strategy_two_payoff, frontier = subtree_partial([root], depth_limit=depth_limit)
+    strategy_one_payoffs = [strategy_one_payoff]
+    strategy_two_payoffs = [strategy_two_payoff]
+
+    if frontier:
+        # Each task is a list holding a single node, and the workers expand their subtrees without a depth limit
+        for strategy_one_payoff, strategy_two_payoff, _ in get_pool().imap_unordered(subtree_partial,
+                                                                                    ([node] for node in frontier),
+                                                                                    chunksize=SUBTREE_CHUNKSIZE):
+            strategy_one_payoffs.append(strategy_one_payoff)
+            strategy_two_payoffs.append(strategy_two_payoff)
+
+    # The subtrees come back in whatever order they finish in, so add them up with fsum, which is exactly rounded and so
+    # gives the same result in any order. Normalise by multiplying by 1 - continuation_probability
+    strategy_one_payoff = fsum(strategy_one_payoffs) * (1 - continuation_probability)
+    strategy_two_payoff = fsum(strategy_two_payoffs) * (1 - continuation_probability)
 
+    return strategy_one_payoff, strategy_two_payoff
 
-    # We initialise the queue with an empty history and a term of 1
-    nodeq.put(Node(coefficient=1, history=('', '')))
 
-    # Set up the values we're going to return
-    strategy_one_payoff = 0.
-    strategy_two_payoff = 0.
+def get_pool():
+    """
+    Get the pool of worker processes, starting it if this is the first time it's been asked for
 
-    # Set up a partial function for the worker functions
-    naive_partial = partial(worker,
-                            nodeq=nodeq,
-                            resultq=resultq,
-                            strategy_one=strategy_one,
-                            strategy_two=strategy_two,
-                            payoff_matrix=payoff_matrix,
-                            continuation_probability=continuation_probability,
-                            mistake_probability=mistake_probability,
-                            epsilon=epsilon)
-
-    # Fire up the workers
-    processes = []
-    for _ in range(cpu_count()):
-        proc = Process(target=naive_partial)
-        proc.start()
-        processes.append(proc)
-
-    # Join the processes
-    for proc in processes:
-        proc.join()
-
-    # Read the values from the result queue and add them up
-    while not resultq.empty():
-        result = resultq.get()
-        strategy_one_payoff += result[0]
-        strategy_two_payoff += result[1]
-
-    # Normalise by multiplying by 1 - continuation_probability
-    strategy_one_payoff *= (1 - continuation_probability)
-    strategy_two_payoff *= (1 - continuation_probability)
+    The same pool is used for every calculation, so the processes are only started once however many calculations are
+    done, and the moves each worker has cached in calculations.cached_next_move carry over from one calculation to the
+    next. The pool is shut down when the interpreter exits.
 
-    return strategy_one_payoff, strategy_two_payoff
+    Returns:
+        pool (Pool): The pool of worker processes
+    """
+    global pool
+    if pool is None:
+        pool = Pool(cpu_count())
+        atexit.register(pool.terminate)
+    return pool
 
 
-def worker(nodeq, resultq, strategy_one, strategy_two, payoff_matrix, continuation_probability, mistake_probability, epsilon):
+def expand_subtree(roots, strategy_one, strategy_two, payoff_matrix, continuation_probability, mistake_probability,
+                   epsilon, depth_limit=None):
     """
-    This method is dispatched to do the work involved in processing each item in the queue
-    """
-    # Set up the strategy objects
-    player_one = strategy_one(C=payoff_matrix.C, D=payoff_matrix.D)
-    player_two = strategy_two(C=payoff_matrix.C, D=payoff_matrix.D)
+    Expand the tree of every possible sequence of mistakes below some nodes, adding up the payoffs
+
+    The nodes are kept on a stack and expanded depth first, as in calculations.expand_history_tree. Each node adds the
+    payoffs of its four outcomes, and has a child for each outcome unless the largest possible term from that outcome is
+    lower than epsilon.
+
+    Args:
+        roots (list): The nodes to expand the subtrees of
+        depth_limit (int): If given, nodes whose histories reach this length are returned rather than expanded
+        Otherwise as per calculate_payoff_with_mistakes
 
-    # Initialise per process totals
-    per_process_total = [0., 0.]
+    Returns:
+        strategy_one_payoff, strategy_two_payoff (float): The total payoffs of the subtrees, not normalised
+        frontier (list): The nodes that reached the depth limit without being expanded
+    """
+    # This stack will hold the nodes that need to be expanded, and the frontier the nodes that reached the depth limit
+    stack = list(roots)
+    frontier = []
 
-    # Set up an internal queue. This minimizes overhead by allowing each queue to work on chunks of the tree, only
-    # stopping to get another chunk once it has finished
-    internalq = queue.Queue()
+    # Set up the values we're going to return
+    strategy_one_payoff = 0.
+    strategy_two_payoff = 0.
 
-    # Figure out the max payoff, since this doesn't change
+    # The moves are looked up from the packed histories, and we need the payoffs of each pair of moves, the opposite of
+    # each move and the bit it packs into. The payoffs are looked up once here rather than calling the payoff matrix for
+    # every outcome
+    C, D = payoff_matrix.C, payoff_matrix.D
+    payoffs = {(move_one, move_two): payoff_matrix.payoff(move_one, move_two)
+               for move_one in (C, D) for move_two in (C, D)}
+    opposite = {C: D, D: C}
+    move_bit = {C: 0, D: 1}
+
+    # Figure out the max payoff and the probabilities of each number of mistakes, with and without the game continuing,
+    # since these don't change between nodes
     payoff_max = payoff_matrix.max()
+    no_mistake_weight = (1 - mistake_probability) ** 2
+    one_mistake_weight = mistake_probability * (1 - mistake_probability)
+    two_mistake_weight = mistake_probability ** 2
+
+    # Whether each player makes a mistake in a round, the probability of that happening, and the probability of that
+    # happening and the game continuing. Every node is expanded into these four outcomes in turn
+    outcomes = [(0, 0, no_mistake_weight, continuation_probability * no_mistake_weight),
+                (1, 0, one_mistake_weight, continuation_probability * one_mistake_weight),
+                (0, 1, one_mistake_weight, continuation_probability * one_mistake_weight),
+                (1, 1, two_mistake_weight, continuation_probability * two_mistake_weight)]
+
+    while stack:
+        node = stack.pop()
+
+        # Leave the nodes at the depth limit to be expanded somewhere else
+        if node.length == depth_limit:
+            frontier.append(node)
+            continue
+
+        # Get the next moves from the packed histories, and the moves that would be played instead if there was a
+        # mistake
+        player_one_move = cached_next_move(strategy_one, C, D, node.bits_one, node.bits_two, node.length)
+        player_two_move = cached_next_move(strategy_two, C, D, node.bits_two, node.bits_one, node.length)
+        player_one_moves = (player_one_move, opposite[player_one_move])
+        player_two_moves = (player_two_move, opposite[player_two_move])
+
+        for mistake_one, mistake_two, weight, continuation_weight in outcomes:
+            player_one_move = player_one_moves[mistake_one]
+            player_two_move = player_two_moves[mistake_two]
 
-    while True:
-        try:
-            try:
-                # Get the first item in the internal queue
-                node = internalq.get_nowait()
-            except queue.Empty:
-                # If it's empty, get the first item in the external queue instead
-                node = nodeq.get(True, 0.1)
+            # Compute the payoff and add it to the total
+            payoff = payoffs[player_one_move, player_two_move]
+            strategy_one_payoff += payoff[0] * weight * node.coefficient
+            strategy_two_payoff += payoff[1] * weight * node.coefficient
 
+            # Add a node to the stack, unless the max term size is too small
+            coefficient = continuation_weight * node.coefficient
+            if coefficient * payoff_max >= epsilon:
+                stack.append(Node(coefficient,
+                                  node.bits_one | (move_bit[player_one_move] << node.length),
+                                  node.bits_two | (move_bit[player_two_move] << node.length),
+                                  node.length + 1))
 
-            # Process the no-mistake case
-            # Unpack the histories
-            player_one.history, player_two.history = node.history
+    return strategy_one_payoff, strategy_two_payoff, frontier
 
-            # Get the next moves
-            player_one_move = player_one.next_move(player_two.history)
-            player_two_move = player_two.next_move(player_one.history)
 
-            # Compute the payoff and add it to the total
-            payoff = payoff_matrix.payoff(player_one_move, player_two_move)
-            strategy_one_payoff = payoff[0] * ((1 - mistake_probability) ** 2) * node.coefficient
-            strategy_two_payoff = payoff[1] * ((1 - mistake_probability) ** 2) * node.coefficient
-            per_process_total[0] += strategy_one_payoff
-            per_process_total[1] += strategy_two_payoff
-
-            # Add an item to the queue, if the max term size is large enough
-            coefficient = continuation_probability * ((1 - mistake_probability) ** 2) * node.coefficient
-            publish_node(coefficient, payoff_max, epsilon, player_one.history + player_one_move, player_two.history + player_two_move, internalq, nodeq)
-
-            # Figure out the case for one mistake
-            # Compute the payoff
-            # Make one mistake
-            player_one_move = player_one.opposite(player_one_move)
-            payoff = payoff_matrix.payoff(player_one_move, player_two_move)
-            strategy_one_payoff = payoff[0] * (mistake_probability * (1 - mistake_probability)) * node.coefficient
-            strategy_two_payoff = payoff[1] * (mistake_probability * (1 - mistake_probability)) * node.coefficient
-            per_process_total[0] += strategy_one_payoff
-            per_process_total[1] += strategy_two_payoff
-
-            # Add to the queue if max term size is large enough
-            coefficient = continuation_probability * (mistake_probability * (1 - mistake_probability)) * node.coefficient
-            publish_node(coefficient, payoff_max, epsilon, player_one.history + player_one_move, player_two.history + player_two_move, internalq, nodeq)
-
-            # Now the other one mistake case
-            # Reverse the mistake we just made
-            player_one_move = player_one.opposite(player_one_move)
-            # Make another mistake
-            player_two_move = player_two.opposite(player_two_move)
-            payoff = payoff_matrix.payoff(player_one_move, player_two_move)
-            strategy_one_payoff = payoff[0] * (mistake_probability * (1 - mistake_probability)) * node.coefficient
-            strategy_two_payoff = payoff[1] * (mistake_probability * (1 - mistake_probability)) * node.coefficient
-            per_process_total[0] += strategy_one_payoff
-            per_process_total[1] += strategy_two_payoff
-
-            # Add to the queue if the max term size is large enough
-            coefficient = continuation_probability * (mistake_probability * (1 - mistake_probability)) * node.coefficient
-            publish_node(coefficient, payoff_max, epsilon, player_one.history + player_one_move, player_two.history + player_two_move, internalq, nodeq)
-
-            # Lastly the two mistake case
-            # Make another mistake for a total of two (the second player has already made a mistake)
-            player_one_move = player_one.opposite(player_one_move)
-            payoff = payoff_matrix.payoff(player_one_move, player_two_move)
-            strategy_one_payoff = payoff[0] * (mistake_probability ** 2) * node.coefficient
-            strategy_two_payoff = payoff[1] * (mistake_probability ** 2) * node.coefficient
-            per_process_total[0] += strategy_one_payoff
-            per_process_total[1] += strategy_two_payoff
-
-            # Add to the queue if the max term size is large enough
-            coefficient = continuation_probability * (mistake_probability ** 2) * node.coefficient
-            publish_node(coefficient, payoff_max, epsilon, player_one.history + player_one_move, player_two.history + player_two_move, internalq, nodeq)
-
-        except queue.Empty:
-            # If the external queue is empty for longer than .5 of a second, we're going to take that as a sign that
-            # there are no mure pieces of the tree to process so we'll return
-            resultq.put(per_process_total)
-            return
-
-def publish_node(coefficient, payoff_matrix_max, epsilon, p_one_history, p_two_history, internal_queue, external_queue):
+def tree_size(continuation_probability, mistake_probability, max_payoff, epsilon, limit):
     """
-    Publish a node to a particular queue, depending on the size of the resultant maximum term and the length of the
-    history
-
-    This method first decides whether we should even publish to the queue by comparing the product of the max term size
-    and the epsilon. If the max term size * coefficient is less than the epsilon, we don't publish to the queue.
+    Count the nodes in the tree of every possible sequence of mistakes, stopping once there are at least limit of them
 
-    If the max term size * epsilon is greater than the epsilon, we must decide which queue to publish too.
-    If the length of the history is sufficiently small (as determined by a constant for now, possibly a variable later
-    if we decide it should be tweakable) then we publish to the global queue that all processes pull form. If the
-    history length is greater than this constant size, we publish to an internal queue.
+    Whether a node is expanded only depends on its coefficient, which for a node n rounds deep whose histories have k
+    mistakes between them is continuation_probability ** n * (1 - mistake_probability) ** (2n - k) *
+    mistake_probability ** k, whatever the strategies are. There are comb(2n, k) such nodes, so we can count the nodes
+    in each round without expanding any of them. The coefficient only gets smaller as k moves away from the most likely
+    number of mistakes, which is 0 if mistake_probability is at most a half and 2n otherwise, so we count outwards from
+    there and stop at the first k whose nodes aren't expanded.
 
     Args:
-        coefficient (float): The coefficient of the node to be published.
-        payoff_matrix_max (float): The maximum payoff for the payoff matrix. Used to determine if we should publish
-            the node.
-        epsilon (float): The term size below which we no longer publish nodes.
-        p_one_history (string): The history of player one. Used as part of the node to publish
-        p_two_history (string): The history of player two. Used as part of the node to publish
-        internal_queue (Queue): The internal queue to publish to if the history length is large
-        external_queue (Queue): The external queue to publish to if the history length is small
+        continuation_probability (float): The probability that another game is played after each round
+        mistake_probability (float): The probability of a single strategy making a mistake in a single round
+        max_payoff (float): The largest payoff possible in a single round
+        epsilon (float): The value at which we truncate the series
+        limit (int): The count to stop at
+
+    Returns:
+        size (int): The number of nodes in the tree, or a number at least as large as limit if there are more
     """
-    EXTERNAL_HISTORY_LIMIT = 2
-    # Decide if we should publish or not
-    if coefficient * payoff_matrix_max < epsilon:
-        # Don't publish
-        pass
-    else:
-        # Create the node object
-        new_node = Node(coefficient, [p_one_history, p_two_history])
-        # Figure out where the node should go
-        if len(p_one_history) <= EXTERNAL_HISTORY_LIMIT:
-            # Publish to the external history
-            external_queue.put(new_node)
-        else:
-            # Publish to the internal queue
-            internal_queue.put(new_node)
+    # The root is always expanded
+    size = 1
+    # Count the mistakes from whichever end is most likely
+    mistakes_first = mistake_probability > 0.5
+
+    rounds = 1
+    while size < limit:
+        added = 0
+        for mistakes in range(2 * rounds + 1):
+            if mistakes_first:
+                mistakes = 2 * rounds - mistakes
+            coefficient = (continuation_probability ** rounds * (1 - mistake_probability) ** (2 * rounds - mistakes) *
+                           mistake_probability ** mistakes)
+            if coefficient * max_payoff < epsilon:
+                break
+            added += comb(2 * rounds, mistakes)
+            if size + added >= limit:
+                break
+
+        # Once no nodes are expanded in a round, there are none in any later round either
+        if added == 0:
+            break
+        size += added
+        rounds += 1
+
+    return size
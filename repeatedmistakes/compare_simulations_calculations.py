@@ -3,6 +3,7 @@ from repeatedmistakes.calculations import calculate_payoff
 from repeatedmistakes.tests.test_calculations import strategy_combinations
 from repeatedmistakes.repeatedgame import PrisonersDilemmaPayoff
 
+from multiprocessing import Pool
 import time
 """
 Here we want to test the simulations against the numerical calculations. We will reuse the sets of strategy pairs from
@@ -15,31 +16,44 @@ TOLERANCE = 0.1
 # The continuation probability
 DELTA = 0.8
 
-def comparison_simulations_passAnyDeltaAndPayoffMatrix_simulationsMatchCalculations():
-    """This tests that the results returned by the simulations match the results of the calculations."""
+def compare_pair(combo):
+    """
+    Compare the simulated and calculated payoffs of the first strategy in a single pair of strategies
+
+    Args:
+        combo (tuple): The two strategies to play against each other
+
+    Returns:
+        diff (float): The difference between the simulation and the calculation, relative to the calculation unless the
+            simulated payoff is within the tolerance of zero
+    """
     # Construct the payoff matrix
     payoff_matrix = PrisonersDilemmaPayoff()
-    for combo in strategy_combinations:
-        # Pull out each strategy
-        strategy_one = combo[0]
-        strategy_two = combo[1]
-        # Get the result from the calcs
-        calculation_result, _ = calculate_payoff(strategy_one, strategy_two, payoff_matrix, DELTA, EPSILON)
-        # Get the result from the sims
-        simulation_result, _ = simulate_payoff(strategy_one, strategy_two, payoff_matrix, DELTA, trials = 1000)
-        # Compare them
-        if abs(simulation_result) > TOLERANCE:
-            diff = abs(simulation_result - calculation_result) / abs(calculation_result)
-            if diff <= TOLERANCE:
-                report_success()
-            else:
-                report_failure(combo, payoff_matrix, DELTA, diff)
+    # Pull out each strategy
+    strategy_one = combo[0]
+    strategy_two = combo[1]
+    # Get the result from the calcs
+    calculation_result, _ = calculate_payoff(strategy_one, strategy_two, payoff_matrix, DELTA, EPSILON)
+    # Get the result from the sims
+    simulation_result, _ = simulate_payoff(strategy_one, strategy_two, payoff_matrix, DELTA, trials = 1000)
+    # Compare them
+    if abs(simulation_result) > TOLERANCE:
+        return abs(simulation_result - calculation_result) / abs(calculation_result)
+    else:
+        return abs(simulation_result - calculation_result)
+
+def comparison_simulations_passAnyDeltaAndPayoffMatrix_simulationsMatchCalculations():
+    """This tests that the results returned by the simulations match the results of the calculations."""
+    # Every pair is independent, so compare them in parallel. map gives back the differences in the same order as the
+    # pairs, so the report comes out the same as doing the pairs one at a time
+    with Pool() as pool:
+        diffs = pool.map(compare_pair, strategy_combinations)
+
+    for combo, diff in zip(strategy_combinations, diffs):
+        if diff <= TOLERANCE:
+            report_success()
         else:
-            diff = abs(simulation_result - calculation_result)
-            if diff <= TOLERANCE:
-                report_success()
-            else:
-                report_failure(combo, payoff_matrix, DELTA, diff)
+            report_failure(combo, PrisonersDilemmaPayoff(), DELTA, diff)
 
 def report_success():
     """Report a successful test"""
@@ -1,10 +1,19 @@
 import math
+import numpy as np
 from collections import namedtuple
-from scipy.optimize import broyden1
-
-HistoryFrame = namedtuple('HistoryFrame', ['player_one_history',
-                                           'player_two_history',
-                                           'mistakes'])
+from repeatedmistakes.calculations import cached_player
+from repeatedmistakes.strategies import COOPERATE, DEFECT
+
+# Some games of a particular length with a particular number of mistakes. The state of each player is whatever decides
+# their next move, which is the state of their state machine where they have one and their history otherwise. A frame
+# can stand for several games that reach the same states, so it keeps the number of games, which is the number of paths
+# through the tree of mistakes to it, and the total payoffs of the rounds played so far added up over all of them
+HistoryFrame = namedtuple('HistoryFrame', ['player_one_state',
+                                           'player_two_state',
+                                           'mistakes',
+                                           'paths',
+                                           'player_one_payoff',
+                                           'player_two_payoff'])
 
 def expected_only(strategy_one, strategy_two, payoff_matrix, continuation_probability, mistake_probability, epsilon):
     """
@@ -12,93 +21,208 @@ def expected_only(strategy_one, strategy_two, payoff_matrix, continuation_probab
 
     This takes an approximate approach to computing the expected payoff by only considerining the terms that arise
     from games with length equal to the expected game length
+
+    When both strategies can be written as state machines, the frames only keep the state of each machine rather than
+    the whole history, so the moves are table lookups. Otherwise the strategies are asked for their moves given the
+    histories.
+    """
+    # Compute the expected number of rounds
+    expected_rounds = math.floor(1 / (1 - continuation_probability))
+
+    # Find the maximum number of allowable mistakes
+    max_mistakes = mistake_limit(continuation_probability, mistake_probability, epsilon)
+
+    # Build every game of the expected length with up to the maximum number of mistakes
+    try:
+        machine_one = cached_player(strategy_one, COOPERATE, DEFECT).state_machine()
+        machine_two = cached_player(strategy_two, COOPERATE, DEFECT).state_machine()
+    except NotImplementedError:
+        frame_list = history_frames(strategy_one, strategy_two, payoff_matrix, expected_rounds, max_mistakes)
+    else:
+        frame_list = state_frames(machine_one, machine_two, payoff_matrix, expected_rounds, max_mistakes)
+
+    # Now we should have a list that contains all of the correct length games with upto the maximum number of mistakes
+    # Gather the number of mistakes and the total payoffs of the games in each frame into arrays
+    mistakes = np.array([frame.mistakes for frame in frame_list], dtype=np.intp)
+    payoffs = np.array([(frame.player_one_payoff, frame.player_two_payoff) for frame in frame_list], dtype=np.float64)
+
+    # We want the game length portion of the coefficient, since this wont change
+    game_length_coefficient = (continuation_probability ** (expected_rounds - 1)) * (1 - continuation_probability)
+    # The mistake portion of the coefficient only depends on the number of mistakes, so compute it once for each number
+    # and look it up for each game
+    mistake_coefficients = np.array([((1 - mistake_probability) ** (2 * expected_rounds - k)) *
+                                     (mistake_probability ** k) for k in range(max_mistakes + 1)])
+
+    # Finally, multiply the payoffs of each frame by the two coefficients and add them up for each player
+    player_one_expected_payoff, player_two_expected_payoff = (
+        game_length_coefficient * (mistake_coefficients[mistakes] @ payoffs))
+
+    # Return the results
+    return float(player_one_expected_payoff), float(player_two_expected_payoff)
+
+
+def mistake_limit(continuation_probability, mistake_probability, epsilon):
+    """
+    Find the largest number of mistakes in a game of the expected length whose term is still at least epsilon
+
+    Args:
+        continuation_probability (float): The probability of continuing the game after each round
+        mistake_probability (float): The probability of a single player making a single mistake in a single round
+        epsilon (float): The smallest term to keep
+
+    Returns:
+        max_mistakes (int): The largest number of mistakes to allow between both players
     """
     # Compute the expected number of rounds
     expected_rounds = math.floor(1 / (1 - continuation_probability))
 
-    # Set up a function that we can solve for the maximum number of mistakes above the threshold
-    def max_mistakes(n):
+    # Set up a function for the size of the terms with a given number of mistakes
+    def mistake_term(n):
         term = (continuation_probability ** (expected_rounds - 1)) * (1 - continuation_probability)
         term = term * ((1 - mistake_probability) ** (2 * expected_rounds - n))
         term = term * (mistake_probability ** n)
         return term
 
-    # Solve for the maximum number of allowable mistakes
-    max_mistakes = broyden1(lambda x: max_mistakes(x) - epsilon, 0)
+    # Both players can make a mistake in every round, so the answer is somewhere between none and 2 * expected_rounds.
+    # If the term is already below epsilon with no mistakes we don't allow any, and if it is still above epsilon with
+    # every possible mistake we allow all of them. Otherwise the term is
+    # mistake_term(0) * (mistake_probability / (1 - mistake_probability)) ** n, which falls as n grows, so we can take
+    # logs and solve for where it reaches epsilon directly. With no chance of a mistake, any mistake gives a term of
+    # zero
+    most_mistakes = 2 * expected_rounds
+    if mistake_term(0) <= epsilon:
+        max_mistakes = 0
+    elif mistake_term(most_mistakes) >= epsilon:
+        max_mistakes = most_mistakes
+    elif mistake_probability == 0:
+        max_mistakes = 0
+    else:
+        max_mistakes = (math.log(epsilon / mistake_term(0)) /
+                        math.log(mistake_probability / (1 - mistake_probability)))
 
     # Take the floor
-    max_mistakes = math.floor(max_mistakes)
+    return math.floor(max_mistakes)
+
+
+def state_frames(machine_one, machine_two, payoff_matrix, rounds, max_mistakes):
+    """
+    Build the frames for every game of a given length with up to a maximum number of mistakes, for two state machines
+
+    What happens in the rest of a game only depends on the states of the machines, and the coefficient of a game only
+    depends on how many mistakes were made, so games that reach the same states with the same number of mistakes are
+    merged into a single frame. The frame counts how many games it stands for and adds up their payoffs, as the nodes
+    are merged in calculations.expand_state_tree. This means the number of frames in a round grows with the number of
+    states and mistakes rather than exponentially.
+
+    Args:
+        machine_one (StateMachine): The state machine of the first strategy, using COOPERATE and DEFECT
+        machine_two (StateMachine): The state machine of the second strategy, using COOPERATE and DEFECT
+        payoff_matrix (PayoffMatrix): An object that gives the payoff for each player given certain actions
+        rounds (int): The length of the games
+        max_mistakes (int): The largest number of mistakes allowed between both players
+
+    Returns:
+        frame_list (list): A HistoryFrame for each set of games ending in the same states with the same mistakes
+    """
+    # Set up the initial frame, keyed on the states and the number of mistakes, with the number of games it stands for
+    # and their total payoffs
+    frames = {(machine_one.initial_state, machine_two.initial_state, 0): (1, 0, 0)}
+
+    # The payoffs indexed by the integer moves
+    payoff_table = payoff_matrix.table.tolist()
+
+    # Loop until we've got the right length of game
+    for _ in range(rounds):
+        # We want to pull each value out of the frames and merge the new values into a new dictionary
+        new_frames = {}
+        for (state_one, state_two, frame_mistakes), (paths, payoff_one, payoff_two) in frames.items():
+            # Look up the next moves
+            player_one_move = machine_one.moves[state_one]
+            player_two_move = machine_two.moves[state_two]
+            # Play the moves with no mistakes, one mistake by either player and two mistakes, as long as we haven't
+            # made too many
+            outcomes = [(player_one_move, player_two_move, frame_mistakes)]
+            if frame_mistakes != max_mistakes:
+                outcomes.append((1 - player_one_move, player_two_move, frame_mistakes + 1))
+                outcomes.append((player_one_move, 1 - player_two_move, frame_mistakes + 1))
+            if frame_mistakes + 2 <= max_mistakes:
+                outcomes.append((1 - player_one_move, 1 - player_two_move, frame_mistakes + 2))
+
+            for move_one, move_two, mistakes in outcomes:
+                # Every game in the frame gets the payoff of this round
+                payoff = payoff_table[move_one][move_two]
+                key = (machine_one.transitions[state_one][move_one][move_two],
+                       machine_two.transitions[state_two][move_two][move_one],
+                       mistakes)
+                child_paths, child_payoff_one, child_payoff_two = new_frames.get(key, (0, 0, 0))
+                new_frames[key] = (child_paths + paths,
+                                   child_payoff_one + payoff_one + paths * payoff[0],
+                                   child_payoff_two + payoff_two + paths * payoff[1])
+
+        # Load the new frames into the old dictionary
+        frames = new_frames
+
+    return [HistoryFrame(state_one, state_two, mistakes, paths, payoff_one, payoff_two)
+            for (state_one, state_two, mistakes), (paths, payoff_one, payoff_two) in frames.items()]
+
+
+def history_frames(strategy_one, strategy_two, payoff_matrix, rounds, max_mistakes):
+    """
+    Build the frames for every game of a given length with up to a maximum number of mistakes, keeping the histories
+
+    This works for any strategy, as the strategies are asked for their moves given the histories in each frame.
 
-    # Set up an initial HistoryFrame
-    initial_frame = HistoryFrame([], [], 0)
+    Args:
+        strategy_one (Strategy): The first strategy in the game
+        strategy_two (Strategy): The other strategy in the game
+        Otherwise as per state_frames
 
-    # Add this to a frame list
-    frame_list = [initial_frame]
+    Returns:
+        frame_list (list): A HistoryFrame for each game, holding the histories of the game. Every game has different
+            histories, so each frame stands for a single game
+    """
+    # Set up an initial HistoryFrame and add it to a frame list
+    frame_list = [HistoryFrame([], [], 0, 1, 0, 0)]
 
     # Create strategy objects that we will use
     player_one = strategy_one(payoff_matrix.C, payoff_matrix.D)
     player_two = strategy_two(payoff_matrix.C, payoff_matrix.D)
 
+    # The moves the players would make instead if they made a mistake. This is a dict lookup rather than a call to
+    # Strategy.opposite, which checks the move against the characterset every time
+    C, D = payoff_matrix.C, payoff_matrix.D
+    opposite = {C: D, D: C}
+
     # Loop until we've got the right length of history
-    for _ in range(expected_rounds):
+    for _ in range(rounds):
         # We want to pull each value out of the frame_list and put the new values into a new list
         new_frame_list = []
         for frame in frame_list:
             # Load the histories into some strategy objects
-            player_one.history = frame.player_one_history
-            player_two.history = frame.player_two_history
+            player_one.history = frame.player_one_state
+            player_two.history = frame.player_two_state
             # Compute the next moves
-            player_one_move = player_one.next_move(player_two.history)
-            player_two_move = player_two.next_move(player_one.history)
-            # Create a new frame with the no-mistake moves
-            new_frame_list.append(HistoryFrame(player_one.history + [player_one_move],
-                                               player_two.history + [player_two_move],
-                                               frame.mistakes))
-            # Make mistakes if we haven't made enough yet
+            player_one_move = player_one.next_move(player_two.history, validate=False)
+            player_two_move = player_two.next_move(player_one.history, validate=False)
+            # Play the moves with no mistakes, one mistake by either player and two mistakes, as long as we haven't
+            # made too many
+            outcomes = [(player_one_move, player_two_move, frame.mistakes)]
             if frame.mistakes != max_mistakes:
-                # Make one mistake
-                new_frame_list.append(HistoryFrame(player_one.history + [player_one.opposite(player_one_move)],
-                                                   player_two.history + [player_two_move],
-                                                   frame.mistakes + 1))
-                # Make the other mistake
-                new_frame_list.append(HistoryFrame(player_one.history + [player_one_move],
-                                                   player_two.history + [player_two.opposite(player_two_move)],
-                                                   frame.mistakes + 1))
-            # See if we can make two mistakes
+                outcomes.append((opposite[player_one_move], player_two_move, frame.mistakes + 1))
+                outcomes.append((player_one_move, opposite[player_two_move], frame.mistakes + 1))
             if frame.mistakes + 2 <= max_mistakes:
-                # Add the frame to the list with both mistakes
-                new_frame_list.append(HistoryFrame(player_one.history + [player_one.opposite(player_one_move)],
-                                                   player_two.history + [player_two.opposite(player_two_move)],
-                                                   frame.mistakes + 2))
+                outcomes.append((opposite[player_one_move], opposite[player_two_move], frame.mistakes + 2))
+
+            for move_one, move_two, mistakes in outcomes:
+                payoff = payoff_matrix.payoff(move_one, move_two)
+                new_frame_list.append(HistoryFrame(player_one.history + [move_one],
+                                                   player_two.history + [move_two],
+                                                   mistakes,
+                                                   1,
+                                                   frame.player_one_payoff + payoff[0],
+                                                   frame.player_two_payoff + payoff[1]))
 
         # Load the new frames into the old list
         frame_list = new_frame_list
 
-    # Now we should have a list that contains all of the correct length games with upto the maximum number of mistakes
-    # Now we loop through each case, compute the total payoff and multiply by the coefficient
-    # Set up variables to hold the expected payoff
-    player_one_expected_payoff = 0
-    player_two_expected_payoff = 0
-    # We want the game length portion of the coefficient, since this wont change
-    game_length_coefficient = (continuation_probability ** (expected_rounds - 1)) * (1 - continuation_probability)
-
-    for frame in frame_list:
-        # Figure out the total payoff
-        player_one_payoff = 0
-        player_two_payoff = 0
-
-        # Loop over the history, adding the payoff each time
-        for player_one_move, player_two_move in zip(frame.player_one_history, frame.player_two_history):
-            payoff = payoff_matrix.payoff(player_one_move, player_two_move)
-            player_one_payoff += payoff[0]
-            player_two_payoff += payoff[1]
-
-        # Compute the coefficient for the number of mistakes
-        mistake_coefficient = ((1 - mistake_probability) ** (2 * expected_rounds - frame.mistakes)) * (mistake_probability ** frame.mistakes)
-
-        # Finally, multiply each player's payoff by the two coefficients and add to the total
-        player_one_expected_payoff += player_one_payoff * game_length_coefficient * mistake_coefficient
-        player_two_expected_payoff += player_two_payoff * game_length_coefficient * mistake_coefficient
-
-    # Return the results
-    return player_one_expected_payoff, player_two_expected_payoff
+    return frame_list
@@ -1,6 +1,11 @@
 from repeatedmistakes.simulations import simulate_payoff
 from repeatedmistakes.calculations import calculate_payoff
-from repeatedmistakes.strategies import InvalidActionError
+from repeatedmistakes.strategies import InvalidActionError, COOPERATE, DEFECT
+import numpy as np
+from collections import namedtuple
+
+# The moves each player made in a simulated game, in the order the players were passed to the game
+SimulationResult = namedtuple('SimulationResult', ['player_one_history', 'player_two_history'])
 
 class RepeatedGame:
     """
@@ -23,7 +28,8 @@ class RepeatedGame:
             rounds (int): The number of rounds to simulate the two strategies playing against each other
 
         Returns:
-            results (dict): A dictionary where the key is the strategy and the value is the list of moves it played
+            results (SimulationResult): The list of moves played by each strategy. This is a tuple rather than a dict
+                keyed on the strategies, so both histories are kept when a strategy plays against itself
         """
         # Set up the two strategies
         player_one = self.strategy_one(C=self.C, D=self.D)
@@ -31,38 +37,41 @@ class RepeatedGame:
         # For each round
         for _ in range(rounds):
             # Figure out what move each strategy makes by passing each other the other player's history
-            move_one = player_one.next_move(player_two.history)
-            move_two = player_two.next_move(player_one.history)
-            # Update the histories of each player
-            player_one.history += move_one
-            player_two.history += move_two
+            move_one = player_one.next_move(player_two.history, validate=False)
+            move_two = player_two.next_move(player_one.history, validate=False)
+            # Update the histories of each player. This appends in place rather than assigning a new history, which
+            # would check the whole history against the characterset every round
+            player_one.observe(move_one, move_two)
+            player_two.observe(move_two, move_one)
 
-        # Construct the result dictionary
-        results = {self.strategy_one: player_one.history, self.strategy_two: player_two.history}
-        return results
+        # Construct the result tuple
+        return SimulationResult(player_one.history, player_two.history)
 
     def simulate_normalised_payoff(self, payoff_matrix, continuation_probability, trials=1000, seed=1234):
         """
         Compute the normalised payoff of each strategy using a monte carlo method.
 
         Args:
-            As per simulations.simulate_normalised_payoff
+            As per simulations.simulate_payoff
 
         Returns:
-            As per simulations.simulate_normalised_payoff
+            As per simulations.simulate_payoff
         """
         return simulate_payoff(self.strategy_one, self.strategy_two, payoff_matrix,
-                                          continuation_probability, trials, seed)
+                               continuation_probability, trials=trials, seed=seed)
 
     def calculate_normalised_payoff(self, payoff_matrix, continuation_probability, epsilon):
         """
         Compute the normalised payoff of each strategy using an iterated sum that stops at some epsilon
 
+        The payoffs of each round are looked up in the payoff matrix's precomputed table of symbol pairs, so the sum
+        doesn't compare moves against the characterset.
+
         Args:
-            As per calculations.calculate_normalised_payoff
+            As per calculations.calculate_payoff
 
-        Returns;
-            As per calculations.calculate_normalised_payoff
+        Returns:
+            As per calculations.calculate_payoff
         """
         return calculate_payoff(self.strategy_one, self.strategy_two, payoff_matrix,
                                            continuation_probability, epsilon)
@@ -79,6 +88,8 @@ class PayoffMatrix:
         CD (float): The payoffs for each player if player one cooperates and the other defects
         DC (float): The payoffs for each player if player one defects and the other cooperates
         DD (float): The payoffs for each player if both players defect
+        table (np.ndarray): A 2x2x2 array where table[move_one, move_two] holds the payoffs for both players, with the
+            moves encoded as the integers COOPERATE and DEFECT
     """
     def __init__(self, C='C', D='D', CC=(2,2), CD=(0,3), DC=(3,0), DD=(1,1)):
         self.C = C
@@ -87,28 +98,52 @@ class PayoffMatrix:
         self.DD = DD
         self.CD = CD
         self.DC = DC
+        # Precompute the payoffs as a lookup from pairs of symbols and as a table indexed by integer moves, so that
+        # neither kind of lookup needs to compare the moves against the characterset. These are built once here, so the
+        # payoffs shouldn't be changed after the matrix is created
+        self._payoffs = {(C, C): CC, (C, D): CD, (D, C): DC, (D, D): DD}
+        self._table = np.empty((2, 2, 2), dtype=np.float64)
+        self._table[COOPERATE, COOPERATE] = CC
+        self._table[COOPERATE, DEFECT] = CD
+        self._table[DEFECT, COOPERATE] = DC
+        self._table[DEFECT, DEFECT] = DD
+        self._max = max(max(CC, DD, DC, CD))
+
+    @property
+    def table(self):
+        return self._table
 
     def payoff(self, player_one, player_two):
-        if player_one == self.C:
-            if player_two == self.C:
-                return self.CC
-            elif player_two == self.D:
-                return self.CD
-        elif player_one == self.D:
-            if player_two == self.C:
-                return self.DC
-            elif player_two == self.D:
-                return self.DD
-        else:
+        """
+        Get the payoffs for each player given the moves they played, in the characterset of this payoff matrix
+
+        Raises:
+            InvalidActionError: Raised if either move is not in the characterset of this payoff matrix
+        """
+        try:
+            return self._payoffs[player_one, player_two]
+        except KeyError:
             raise InvalidActionError("Moves not in the characterset of this payoff matrix were passed.")
 
+    def payoff_idx(self, player_one, player_two):
+        """
+        Get the payoffs for each player given the moves they played, encoded as the integers COOPERATE and DEFECT
+
+        This is a single table lookup with no validation, for use in the simulation kernels.
+
+        Returns:
+            payoffs (np.ndarray): The payoffs of player one and player two
+        """
+        return self._table[player_one, player_two]
+
     def max(self):
         """
         Compute the maximum possible payoff for any player
 
-        This is used in calculations to truncate the series once the maximum possible term is too small.
+        This is used in calculations to truncate the series once the maximum possible term is too small. It is worked
+        out once when the matrix is created, along with the other precomputed payoffs.
         """
-        return max(max(self.CC, self.DD, self.DC, self.CD))
+        return self._max
 
 
 class PrisonersDilemmaPayoff(PayoffMatrix):
@@ -1,9 +1,15 @@
 """
 Contains functions used to simulate different scenarios involving the iterated prisoner's dilemma
 """
-from numpy.random import RandomState
+from numpy.random import default_rng
 import numpy as np
 from math import sqrt
+from functools import partial
+from repeatedmistakes.strategies import COOPERATE, DEFECT
+from repeatedmistakes.simulations_batched import state_machine_tables, play_games
+
+# The largest number of games that are played at once when the number of trials is fixed, which bounds the memory used
+TRIAL_BATCH_SIZE = 2 ** 20
 
 
 def simulate_payoff(strategy_one, strategy_two, payoff_matrix, continuation_probability,
@@ -17,6 +23,10 @@ def simulate_payoff(strategy_one, strategy_two, payoff_matrix, continuation_prob
     trials so that we can guarantee that the standard deviation of the normalised payoff is within the passed bound.
     We then calculate the mean of these trials to get our simulated normalised payoff
 
+    When the number of trials is fixed, the games are all played at once in lockstep with simulations_batched.play_games
+    rather than one at a time, since we know up front how many we need. This needs both strategies to be state
+    machines, so if either isn't, the games are played one at a time with perform_trial.
+
     Args:
         strategy_one (Strategy): The strategy to be tested
         strategy_two (Strategy): The other strategy
@@ -29,12 +39,47 @@ def simulate_payoff(strategy_one, strategy_two, payoff_matrix, continuation_prob
 
     Returns:
         strategy_one_normalised_payoff, strategy_two_normalised_payoff: the normalised payoffs
+
+    Raises:
+        ValueError: If a fixed number of trials is asked for and it is less than one, since the mean of no trials
+            isn't defined
     """
-    # Create an PRNG instance and seed it
-    random_instance = RandomState(seed)
+    if estimator_stdev is None and trials < 1:
+        raise ValueError('The number of trials must be at least one')
+
+    # Create an PRNG instance and seed it. This uses the PCG64 generator, which is quicker than the legacy Mersenne
+    # Twister in RandomState
+    random_instance = default_rng(seed)
+
+    # Create the players using the integer moveset so that the payoffs can be looked up in a table
+    player_one = strategy_one(C=COOPERATE, D=DEFECT)
+    player_two = strategy_two(C=COOPERATE, D=DEFECT)
+
+    if estimator_stdev is None:
+        payoff_sums = np.zeros(2)
+        if player_one.has_state_machine and player_two.has_state_machine:
+            # Play the games in batches, with strategy 0 in the tables as player one and strategy 1 as player two
+            initial_states, moves, transitions = state_machine_tables((strategy_one, strategy_two))
+            for first_trial in range(0, trials, TRIAL_BATCH_SIZE):
+                batch_trials = min(TRIAL_BATCH_SIZE, trials - first_trial)
+                payoffs = play_games(np.zeros(batch_trials, dtype=np.intp), np.ones(batch_trials, dtype=np.intp),
+                                     initial_states, moves, transitions, payoff_matrix.table,
+                                     continuation_probability, mistake_probability, random_instance)
+                payoff_sums += payoffs.sum(axis=0)
+        else:
+            # A strategy without a state machine can't be played in lockstep, so play the games one at a time
+            for _ in range(trials):
+                payoff_sums += perform_trial(player_one, player_two, payoff_matrix.table, continuation_probability,
+                                             random_instance, mistake_probability)
+
+        strategy_one_normalised_payoff, strategy_two_normalised_payoff = \
+            payoff_sums / trials * (1 - continuation_probability)
+        return strategy_one_normalised_payoff, strategy_two_normalised_payoff
 
-    strategy_one_payoffs = []
-    strategy_two_payoffs = []
+    # Keep running means and sums of squared deviations of the payoffs, updated with Welford's method, so that the
+    # standard deviation can be checked after every trial without going back over all of the earlier trials
+    strategy_one_mean = strategy_two_mean = 0.
+    strategy_one_squares = strategy_two_squares = 0.
 
     # Count the number of trials
     number_of_trials = 0
@@ -42,52 +87,62 @@ def simulate_payoff(strategy_one, strategy_two, payoff_matrix, continuation_prob
     # Set up the continuation variable
     cont = True
 
-    # Create the players with the movesets from the payoff matrix
-    player_one = strategy_one(C=payoff_matrix.C, D=payoff_matrix.D)
-    player_two = strategy_two(C=payoff_matrix.C, D=payoff_matrix.D)
+    # Every trial is played by the same pair of strategies, so where they can be written as state machines, fix their
+    # tables into a trial function that plays the game with nothing but lookups. Otherwise play the strategy objects
+    # with perform_trial, which keeps the histories that a strategy without a state machine picks its moves from
+    if player_one.has_state_machine and player_two.has_state_machine:
+        play_trial = partial(perform_machine_trial, player_one.state_machine(), player_two.state_machine(),
+                             payoff_matrix.table.tolist())
+    else:
+        play_trial = partial(perform_trial, player_one, player_two, payoff_matrix.table)
 
     while cont:
         number_of_trials += 1
 
-        # Perform the trials and add them to the dataframe
-        trial = perform_trial(player_one, player_two, payoff_matrix, continuation_probability, random_instance)
-        strategy_one_payoffs.append(trial[0])
-        strategy_two_payoffs.append(trial[1])
-
-        if estimator_stdev is None:
-            if number_of_trials >= trials:
+        # Perform the trials and add them to the running moments
+        trial = play_trial(continuation_probability, random_instance, mistake_probability)
+        strategy_one_delta = trial[0] - strategy_one_mean
+        strategy_two_delta = trial[1] - strategy_two_mean
+        strategy_one_mean += strategy_one_delta / number_of_trials
+        strategy_two_mean += strategy_two_delta / number_of_trials
+        strategy_one_squares += strategy_one_delta * (trial[0] - strategy_one_mean)
+        strategy_two_squares += strategy_two_delta * (trial[1] - strategy_two_mean)
+
+        if number_of_trials > 100:
+            # Compute the sample standard deviation for both players
+            strategy_one_stdev = sqrt(strategy_one_squares / number_of_trials)
+            strategy_two_stdev = sqrt(strategy_two_squares / number_of_trials)
+            # Divide these by the sqrt of the number of trials
+            strategy_one_stdev /= sqrt(number_of_trials)
+            strategy_two_stdev /= sqrt(number_of_trials)
+            # If both are below threshold, break
+            if strategy_one_stdev < estimator_stdev and strategy_two_stdev < estimator_stdev:
                 break
-        else:
-            if number_of_trials > 100:
-                # Compute the sample standard deviation for both players
-                strategy_one_stdev = np.array(strategy_one_payoffs).std()
-                strategy_two_stdev = np.array(strategy_two_payoffs).std()
-                # Divide these by the sqrt of the number of trials
-                strategy_one_stdev /= sqrt(number_of_trials)
-                strategy_two_stdev /= sqrt(number_of_trials)
-                # If both are below threshold, break
-                if strategy_one_stdev < estimator_stdev and strategy_two_stdev < estimator_stdev:
-                    break
-
-    strategy_one_normalised_payoff = np.array(strategy_one_payoffs).mean() * (1 - continuation_probability)
-    strategy_two_normalised_payoff = np.array(strategy_two_payoffs).mean() * (1 - continuation_probability)
+
+    strategy_one_normalised_payoff = strategy_one_mean * (1 - continuation_probability)
+    strategy_two_normalised_payoff = strategy_two_mean * (1 - continuation_probability)
     return strategy_one_normalised_payoff, strategy_two_normalised_payoff
 
 
-def perform_trial(player_one, player_two, payoff_matrix, continuation_probability, random_instance,
+def perform_trial(player_one, player_two, payoff_table, continuation_probability, random_instance,
                   mistake_probability=0.):
     """
     Perform one game of the iterated prisoners dilemma and return the payoff for each player
 
-    This simulates the game between two players, recording the total payoff. We keep simulating the game until the
-    random value we pick is above the continuation probability.
+    This simulates the game between two players, recording the total payoff. The game ends after each round with
+    probability 1 - continuation_probability, so the number of rounds is geometrically distributed. We draw the number
+    of rounds and whether each player makes a mistake in each round up front, which takes two calls to the random
+    number generator per game rather than three per round.
+
+    Moves are encoded as the integers COOPERATE and DEFECT, so both players must have been created with that
+    characterset. This lets us flip a move with a subtraction and look the payoffs up in a table.
 
     Args:
         player_one (Strategy): The first player
         player_two (Strategy): The second player
-        payoff_matrix (PayoffMatrix): The payoff matrix representing the reward for each action
+        payoff_table (np.ndarray): The table of payoffs for each pair of moves, as given by PayoffMatrix.table
         continuation_probability (float): The probability of continuing each game
-        random_instance (RandomState): A random state instance with which to generate random numbers
+        random_instance (Generator): A random generator instance with which to generate random numbers
         mistake_probability (float): Probability of a single player making a single mistake in a round, default is 0
 
     Returns:
@@ -97,36 +152,91 @@ def perform_trial(player_one, player_two, payoff_matrix, continuation_probabilit
     player_one_payoff = 0.
     player_two_payoff = 0.
 
-    # Set up the continuation variable
-    cont = True
-
     # Reset the strategy objects
     player_one.reset()
     player_two.reset()
 
-    while cont:
-        player_one_move = player_one.next_move(player_two.history)
-        player_two_move = player_two.next_move(player_one.history)
+    # State machines don't need the histories, so we only record the moves in their states. A strategy without a state
+    # machine picks its moves from both histories, so if either player doesn't have one, both keep their histories
+    if player_one.has_state_machine and player_two.has_state_machine:
+        observe_one, observe_two = player_one.fast_observe, player_two.fast_observe
+    else:
+        observe_one, observe_two = player_one.observe, player_two.observe
+
+    # Draw the length of the game and the mistakes each player makes in each round. The mistakes are converted to a list
+    # since indexing into a list of Python bools is much quicker than indexing into a numpy array one element at a time
+    rounds = random_instance.geometric(1 - continuation_probability)
+    mistakes = (random_instance.random((rounds, 2)) < mistake_probability).tolist()
+
+    for mistake_one, mistake_two in mistakes:
+        # The strategies look their moves up from the state of their state machines, so they don't need the histories.
+        # Strategies without a state machine are passed their opponent's history
+        player_one_move = player_one.fast_next_move(player_two.history)
+        player_two_move = player_two.fast_next_move(player_one.history)
+
+        # Apply any mistakes
+        if mistake_one:
+            player_one_move = 1 - player_one_move
+        if mistake_two:
+            player_two_move = 1 - player_two_move
 
-        # Check for mistake in player one
-        if random_instance.random_sample() < mistake_probability:
-            player_one_move = player_one.opposite(player_one_move)
+        # Calculate payoffs and add them to the total
+        payoff_one, payoff_two = payoff_table[player_one_move, player_two_move]
+        player_one_payoff += payoff_one
+        player_two_payoff += payoff_two
 
-        # Check for mistake in player two
-        if random_instance.random_sample() < mistake_probability:
-            player_two_move = player_two.opposite(player_two_move)
+        # Let the strategies update their state. When both are state machines the histories aren't kept, so the time
+        # and memory for each round stays the same however long the game goes on
+        observe_one(player_one_move, player_two_move)
+        observe_two(player_two_move, player_one_move)
+
+    return player_one_payoff, player_two_payoff
+
+
+def perform_machine_trial(machine_one, machine_two, payoff_table, continuation_probability, random_instance,
+                          mistake_probability=0.):
+    """
+    Perform one game of the iterated prisoners dilemma between two state machines and return the payoff for each player
+
+    This plays the game in the same way as perform_trial, drawing the same random numbers, so it gives the same payoffs.
+    The states of the machines are kept in local variables and the moves and payoffs are looked up in nested lists,
+    so each round is a handful of list lookups rather than method calls on the strategy objects.
+
+    Args:
+        machine_one (StateMachine): The state machine of the first player, using COOPERATE and DEFECT
+        machine_two (StateMachine): The state machine of the second player, using COOPERATE and DEFECT
+        payoff_table (list): The payoffs for each pair of moves, as given by PayoffMatrix.table converted to a list
+        Otherwise as per perform_trial
+
+    Returns:
+        player_one_payoff, player_two_payoff: The payoffs of each player
+    """
+    # Pull the tables out of the machines so they are local lookups in the loop
+    moves_one, transitions_one = machine_one.moves, machine_one.transitions
+    moves_two, transitions_two = machine_two.moves, machine_two.transitions
+    state_one = machine_one.initial_state
+    state_two = machine_two.initial_state
+
+    # Set up the total payoffs
+    player_one_payoff = 0.
+    player_two_payoff = 0.
+
+    # Draw the length of the game and the mistakes each player makes in each round, as in perform_trial
+    rounds = random_instance.geometric(1 - continuation_probability)
+    mistakes = (random_instance.random((rounds, 2)) < mistake_probability).tolist()
+
+    for mistake_one, mistake_two in mistakes:
+        # Look up the moves and apply any mistakes
+        player_one_move = moves_one[state_one] ^ mistake_one
+        player_two_move = moves_two[state_two] ^ mistake_two
 
         # Calculate payoffs and add them to the total
-        payoff_one, payoff_two = payoff_matrix.payoff(player_one=player_one_move, player_two=player_two_move)
+        payoff_one, payoff_two = payoff_table[player_one_move][player_two_move]
         player_one_payoff += payoff_one
         player_two_payoff += payoff_two
 
-        # Update the histories of the strategies
-        player_one.history += player_one_move
-        player_two.history += player_two_move
-
-        # Figure out whether we should continue or not
-        if random_instance.random_sample() > continuation_probability:
-            cont = False
+        # Move the machines on to their next states
+        state_one = transitions_one[state_one][player_one_move][player_two_move]
+        state_two = transitions_two[state_two][player_two_move][player_one_move]
 
     return player_one_payoff, player_two_payoff
@@ -0,0 +1,156 @@
+"""
+Contains functions used to simulate the iterated prisoner's dilemma for many pairs of strategies at once
+
+Rather than playing one game at a time through the strategy objects, every strategy is written as a finite state machine
+and all of the games for all of the pairs are played together in lockstep with numpy, one round at a time.
+"""
+from numpy.random import default_rng
+from functools import lru_cache
+import numpy as np
+from repeatedmistakes.strategies import COOPERATE, DEFECT
+
+
+def simulate_payoffs(strategies, payoff_matrix, continuation_probability, mistake_probability=0., trials=1000,
+                     seed=1234, batch_size=2 ** 20):
+    """
+    Calculate the normalised payoffs for every pair of strategies in the iterated prisoner's dilemma
+
+    This does the same monte carlo simulation as simulations.simulate_payoff, but for every ordered pair of the given
+    strategies at once. Each strategy is converted to its state machine, and the state machines are padded to the same
+    number of states and stacked into tables. The games are then played with a handful of array operations per round,
+    so the cost of the python interpreter is paid once per round rather than once per move of every game.
+
+    Args:
+        strategies (list): The strategy classes to simulate. Every ordered pair of them is simulated.
+        payoff_matrix (PayoffMatrix): An object that gives the payoff for each player given certain actions
+        continuation_probability (float): The probability of continuing each game
+        mistake_probability (float): Probability of a single player making a single mistake in a round, default is 0
+        trials (int): The number of games to play for each pair of strategies
+        seed (int): A seed for the random number generator
+        batch_size (int): The maximum number of games to play at once, which bounds the memory used
+
+    Returns:
+        payoffs (np.ndarray): An array of shape (len(strategies), len(strategies), 2) where payoffs[i, j] holds the
+            normalised payoffs of strategies[i] and strategies[j] when strategies[i] plays strategies[j]
+    """
+    number_of_strategies = len(strategies)
+    number_of_pairs = number_of_strategies ** 2
+
+    initial_states, moves, transitions = state_machine_tables(tuple(strategies))
+
+    # Pair p is strategies[p // n] playing strategies[p % n]
+    pair_strategy_one, pair_strategy_two = np.divmod(np.arange(number_of_pairs), number_of_strategies)
+
+    random_instance = default_rng(seed)
+    payoff_sums = np.zeros((number_of_pairs, 2))
+
+    # Play the trials in batches with the same number of games for each pair
+    trials_per_batch = max(1, batch_size // number_of_pairs)
+    for first_trial in range(0, trials, trials_per_batch):
+        batch_trials = min(trials_per_batch, trials - first_trial)
+        game_pairs = np.repeat(np.arange(number_of_pairs), batch_trials)
+        game_payoffs = play_games(pair_strategy_one[game_pairs], pair_strategy_two[game_pairs], initial_states,
+                                  moves, transitions, payoff_matrix.table, continuation_probability,
+                                  mistake_probability, random_instance)
+        # Add the total payoff of each game to the total for its pair
+        for player in range(2):
+            payoff_sums[:, player] += np.bincount(game_pairs, weights=game_payoffs[:, player], minlength=number_of_pairs)
+
+    normalised_payoffs = payoff_sums / trials * (1 - continuation_probability)
+    return normalised_payoffs.reshape((number_of_strategies, number_of_strategies, 2))
+
+
+@lru_cache(maxsize=None)
+def state_machine_tables(strategies):
+    """
+    Stack the state machines of some strategies into tables indexed by the strategy first
+
+    Strategies with fewer states than the largest machine are padded with states they never reach. The tables are
+    cached, so a driver that sweeps over many parameter values only builds them once. The cached arrays are shared
+    between callers, so they are made read only.
+
+    Args:
+        strategies (tuple): The strategy classes to tabulate. This needs to be hashable for the cache.
+
+    Returns:
+        initial_states, moves, transitions (np.ndarray): The tables, as described in play_games
+    """
+    machines = [strategy(C=COOPERATE, D=DEFECT).state_machine() for strategy in strategies]
+    number_of_states = max(len(machine.moves) for machine in machines)
+    initial_states = np.array([machine.initial_state for machine in machines], dtype=np.intp)
+    moves = np.zeros((len(strategies), number_of_states), dtype=np.intp)
+    transitions = np.zeros((len(strategies), number_of_states, 2, 2), dtype=np.intp)
+    for index, machine in enumerate(machines):
+        moves[index, :len(machine.moves)] = machine.moves
+        transitions[index, :len(machine.moves)] = machine.transitions
+    for table in (initial_states, moves, transitions):
+        table.setflags(write=False)
+    return initial_states, moves, transitions
+
+
+def play_games(strategy_one, strategy_two, initial_states, moves, transitions, payoff_table, continuation_probability,
+               mistake_probability, random_instance):
+    """
+    Play a batch of games of the iterated prisoners dilemma in lockstep and return the total payoffs of each game
+
+    As in simulations.perform_trial, the number of rounds in each game is geometrically distributed. We sort the games
+    from longest to shortest, so that the games still being played in any round are always a prefix of the arrays and
+    we can slice them off rather than masking the finished games.
+
+    Args:
+        strategy_one (np.ndarray): The index of the strategy playing as player one in each game
+        strategy_two (np.ndarray): The index of the strategy playing as player two in each game
+        initial_states (np.ndarray): The initial state of each strategy
+        moves (np.ndarray): The table of moves indexed by [strategy, state]
+        transitions (np.ndarray): The table of transitions indexed by [strategy, state, own_move, opponent_move]
+        payoff_table (np.ndarray): The table of payoffs for each pair of moves, as given by PayoffMatrix.table
+        continuation_probability (float): The probability of continuing each game
+        mistake_probability (float): Probability of a single player making a single mistake in a round
+        random_instance (Generator): A random generator instance with which to generate random numbers
+
+    Returns:
+        payoffs (np.ndarray): An array of shape (number of games, 2) holding the total payoffs of both players in each
+            game, in the same order as the games were passed
+    """
+    number_of_games = len(strategy_one)
+    # With no games there are no rounds to play, and nothing to take the longest game from
+    if number_of_games == 0:
+        return np.zeros((0, 2))
+    rounds = random_instance.geometric(1 - continuation_probability, size=number_of_games)
+
+    # Sort the games from longest to shortest, and work out how many games are still being played in each round
+    order = np.argsort(-rounds, kind='stable')
+    strategy_one = strategy_one[order]
+    strategy_two = strategy_two[order]
+    games_playing = number_of_games - np.cumsum(np.bincount(rounds))
+
+    state_one = initial_states[strategy_one]
+    state_two = initial_states[strategy_two]
+    payoffs = np.zeros((number_of_games, 2))
+
+    for round_index in range(rounds.max()):
+        playing = games_playing[round_index]
+        # Drop the games that have finished
+        strategy_one = strategy_one[:playing]
+        strategy_two = strategy_two[:playing]
+        state_one = state_one[:playing]
+        state_two = state_two[:playing]
+
+        move_one = moves[strategy_one, state_one]
+        move_two = moves[strategy_two, state_two]
+
+        # Apply any mistakes
+        if mistake_probability > 0:
+            mistakes = random_instance.random((2, playing)) < mistake_probability
+            move_one ^= mistakes[0]
+            move_two ^= mistakes[1]
+
+        payoffs[:playing] += payoff_table[move_one, move_two]
+
+        state_one = transitions[strategy_one, state_one, move_one, move_two]
+        state_two = transitions[strategy_two, state_two, move_two, move_one]
+
+    # Put the payoffs back in the order the games were passed
+    unsorted_payoffs = np.empty_like(payoffs)
+    unsorted_payoffs[order] = payoffs
+    return unsorted_payoffs
@@ -2,18 +2,23 @@
 Contains functions used to simulate different scenarios involving the iterated prisoner's dilemma, but taking advantage
 of multithreading
 """
-from numpy.random import RandomState
+from numpy.random import default_rng, SeedSequence
 import numpy as np
 from math import sqrt
+from repeatedmistakes.simulations_batched import state_machine_tables, play_games
 from repeatedmistakes.simulations import perform_trial
-from multiprocessing import Pool, cpu_count, Manager
+from repeatedmistakes.strategies import COOPERATE, DEFECT
+from multiprocessing import Pool, cpu_count
 from functools import partial
 
 TRIAL_INCREMENT = 1000
+# The number of chunks of trials to queue for each process. Game lengths vary a lot, so having a few chunks per process
+# lets the processes that finish early pick up more work rather than waiting on the slowest chunk
+CHUNKS_PER_PROCESS = 4
 
 
 def simulate_payoff(strategy_one, strategy_two, payoff_matrix, continuation_probability,
-                    mistake_probability=0., trials=1000, estimator_stdev=None):
+                    mistake_probability=0., trials=1000, estimator_stdev=None, seed=None):
     """
     Calculate the normalised payoff for each strategy in the iterated prisoner's dilemma
 
@@ -22,7 +27,8 @@ def simulate_payoff(strategy_one, strategy_two, payoff_matrix, continuation_prob
     probability). The number of trials performed is either passed as a parameter or alternatively we generate enough
     trials so that we can guarantee that the standard deviation of the normalised payoff is within the passed bound.
     In order to facilitate efficient multiprocessing:
-        * If we are given a set number of trials, we simply split up the work evenly among the processes
+        * If we are given a set number of trials, we split them into a few chunks for each process, which the processes
+            take from a shared queue as they finish the previous ones
         * If we are given a target standard deviation then we use the number of trials as a baseline, and then compute
             further trials in batches from there until we have the required standard deviation. This allows us to make
             efficient use of the processors.
@@ -36,23 +42,27 @@ def simulate_payoff(strategy_one, strategy_two, payoff_matrix, continuation_prob
         mistake_probability (float): The probability of a single player making a single mistake in a single round
         trials (int): The number of games to simulate in order to calculate the normalised payoff
         estimator_stdev (float): The allowable deviation of our estimator.
+        seed (int): A seed for the PRNG. Each chunk of trials draws from its own stream spawned from this seed, so the
+            result is the same however the chunks are shared between the processes. If None, the seed is taken from
+            the operating system.
 
     Returns:
         strategy_one_normalised_payoff, strategy_two_normalised_payoff: the normalised payoffs
     """
-    strategy_one_payoffs = []
-    strategy_two_payoffs = []
+    # Keep running totals of the payoffs and the squared payoffs of each player. These are all we need for the mean
+    # and the standard deviation, so we never have to hold on to the individual trials
+    payoff_sums = np.zeros(2)
+    payoff_square_sums = np.zeros(2)
 
-    # Set up a queue to store results
-    m = Manager()
-    q = m.Queue()
+    # Every chunk of trials gets its own independent stream of random numbers, spawned from a single seed sequence
+    seed_sequence = SeedSequence(seed)
 
-    # Split the trials into chunks for each process
-    trial_chunks = [trials//cpu_count() for _ in range(cpu_count())]
+    # Split the trials into chunks for the processes
+    trial_chunks = split_trials(trials, cpu_count() * CHUNKS_PER_PROCESS)
 
     # Since all of the parameters remain the same across each process other than the number of trials, we create
     # a partial function with these values already prefilled, and map these onto the processes.
-    partial_trials = partial(perform_multiple_trials, q=q, strategy_one=strategy_one, strategy_two=strategy_two,
+    partial_trials = partial(perform_multiple_trials, strategy_one=strategy_one, strategy_two=strategy_two,
                              payoff_matrix=payoff_matrix,
                              continuation_probability=continuation_probability,
                              mistake_probability=mistake_probability)
@@ -60,22 +70,20 @@ def simulate_payoff(strategy_one, strategy_two, payoff_matrix, continuation_prob
     # We need to count the number of trials in order to compute the estimator stdev
     number_of_trials = 0
 
-    while True:
-        # Get a pool of workers
-        with Pool() as pool:
-            # Get the workers to do the work. The results are placed into a queue as lists
-            pool.map(partial_trials, trial_chunks)
-
-            # Get the lists from the queue
-            for i in range(cpu_count()):
+    # Get a pool of workers. The same pool is reused for every batch of trials, rather than paying for a new set of
+    # processes each time we check the standard deviation
+    with Pool() as pool:
+        while True:
+            # Get the workers to do the work, handing each chunk its seed. With a chunksize of one the workers still
+            # take the chunks one at a time as they become free, but imap (rather than imap_unordered) hands the
+            # results back in the order the chunks were queued, so the sums are added up in the same order every run
+            chunks = zip(trial_chunks, seed_sequence.spawn(len(trial_chunks)))
+            for chunk_trials, chunk_sums, chunk_square_sums in pool.imap(partial_trials, chunks, chunksize=1):
                 # Update the number of trials. Might as well do it when we're already looping
-                number_of_trials += trial_chunks[i]
-                # Get the trial list
-                trial_list = q.get()
-                # Split each trial into the first and second strategy payoffs
-                for trial in trial_list:
-                    strategy_one_payoffs.append(trial[0])
-                    strategy_two_payoffs.append(trial[1])
+                number_of_trials += chunk_trials
+                # Add the chunk to the running totals
+                payoff_sums += chunk_sums
+                payoff_square_sums += chunk_square_sums
 
             # If we didn't pass a target stdev for the estimator then we've done all the trials we need
             if estimator_stdev is None:
@@ -83,40 +91,87 @@ def simulate_payoff(strategy_one, strategy_two, payoff_matrix, continuation_prob
 
             # If we have passed an estimator stdev target
             else:
-                # Compute the sample standard deviation for both players
-                strategy_one_stdev = np.array(strategy_one_payoffs).std()
-                strategy_two_stdev = np.array(strategy_two_payoffs).std()
+                # Compute the sample standard deviation for both players from the running totals. Clip the variance
+                # at zero, since rounding can push it slightly negative when every trial has the same payoff
+                means = payoff_sums / number_of_trials
+                stdevs = np.sqrt(np.maximum(payoff_square_sums / number_of_trials - means ** 2, 0.))
                 # Divide these by the sqrt of the number of trials
-                strategy_one_stdev /= sqrt(number_of_trials)
-                strategy_two_stdev /= sqrt(number_of_trials)
+                stdevs /= sqrt(number_of_trials)
                 # If both are below threshold, break
-                if strategy_one_stdev < estimator_stdev and strategy_two_stdev < estimator_stdev:
+                if stdevs[0] < estimator_stdev and stdevs[1] < estimator_stdev:
                     break
                 else:
                     # Otherwise, recompute the trial chunk lists. This effectively queues some more trials for when
                     # we go through the look again.
-                    trial_chunks = [TRIAL_INCREMENT//cpu_count() for _ in range(cpu_count())]
+                    trial_chunks = split_trials(TRIAL_INCREMENT, cpu_count() * CHUNKS_PER_PROCESS)
 
-    strategy_one_normalised_payoff = np.array(strategy_one_payoffs).mean() * (1 - continuation_probability)
-    strategy_two_normalised_payoff = np.array(strategy_two_payoffs).mean() * (1 - continuation_probability)
+    strategy_one_normalised_payoff, strategy_two_normalised_payoff = \
+        payoff_sums / number_of_trials * (1 - continuation_probability)
     return strategy_one_normalised_payoff, strategy_two_normalised_payoff
 
 
-def perform_multiple_trials(n, q, strategy_one, strategy_two, payoff_matrix, continuation_probability, mistake_probability):
-    # Create an PRNG instance. This instance will take a random seed. This is good because we don't want all instances
-    # using the same seed and then creating the same data.
-    random_instance = RandomState()
+def split_trials(trials, chunks):
+    """
+    Split a number of trials into chunks that add up to exactly that number of trials
+
+    Args:
+        trials (int): The number of trials to split up
+        chunks (int): The number of chunks to aim for
+
+    Returns:
+        trial_chunks (list): The number of trials in each chunk. There are fewer chunks than asked for if there aren't
+            enough trials to give each chunk at least one, and the last chunk holds any remainder
+    """
+    chunk = max(1, trials // chunks)
+    trial_chunks = [chunk] * (trials // chunk)
+    if trials % chunk:
+        trial_chunks.append(trials % chunk)
+    return trial_chunks
+
 
-    # Create the players with the movesets from the payoff matrix
-    player_one = strategy_one(C=payoff_matrix.C, D=payoff_matrix.D)
-    player_two = strategy_two(C=payoff_matrix.C, D=payoff_matrix.D)
+def perform_multiple_trials(chunk, strategy_one, strategy_two, payoff_matrix, continuation_probability,
+                            mistake_probability):
+    """
+    Perform a chunk of trials in a worker process
 
-    trial_list = []
+    All of the games in the chunk are played at once with simulations_batched.play_games, so the random numbers for
+    the whole chunk are drawn in one call for the lengths of the games and one call per round for the mistakes, rather
+    than two calls for every game. If either strategy isn't a state machine, the games are played one at a time with
+    simulations.perform_trial instead.
 
-    for _ in range(n):
-        # Perform the trials and add them to the list
-        trial_list.append(perform_trial(player_one, player_two, payoff_matrix, continuation_probability, random_instance, mistake_probability))
+    Args:
+        chunk (tuple): The number of trials to perform and the SeedSequence to seed the PRNG with
+        strategy_one (Strategy): The class of the first player
+        strategy_two (Strategy): The class of the second player
+        Otherwise as per simulate_payoff
 
-    # When we've compute all of the trials in this chunk, put the results in the result queue so that the main process
-    # can aggregate them.
-    q.put(trial_list)
+    Returns:
+        n (int): The number of trials performed
+        payoff_sums (np.ndarray): The total payoff of each player over the trials
+        payoff_square_sums (np.ndarray): The total of the squared payoffs of each player over the trials
+    """
+    n, chunk_seed = chunk
+
+    # Create an PRNG instance from this chunk's seed. Every chunk has a different seed, so we don't get the same data in
+    # each chunk
+    random_instance = default_rng(chunk_seed)
+
+    # Create the players using the integer moveset so that the payoffs can be looked up in a table
+    player_one = strategy_one(C=COOPERATE, D=DEFECT)
+    player_two = strategy_two(C=COOPERATE, D=DEFECT)
+
+    # Play the trials. Each row holds the payoffs of both players for one trial
+    if player_one.has_state_machine and player_two.has_state_machine:
+        # Play them all at once, with strategy 0 in the tables as player one and strategy 1 as player two
+        initial_states, moves, transitions = state_machine_tables((strategy_one, strategy_two))
+        trial_array = play_games(np.zeros(n, dtype=np.intp), np.ones(n, dtype=np.intp), initial_states, moves,
+                                 transitions, payoff_matrix.table, continuation_probability, mistake_probability,
+                                 random_instance)
+    else:
+        # A strategy without a state machine can't be played in lockstep, so play the games one at a time
+        trial_array = np.array([perform_trial(player_one, player_two, payoff_matrix.table, continuation_probability,
+                                              random_instance, mistake_probability) for _ in range(n)]).reshape(n, 2)
+
+    # When we've computed all of the trials in this chunk, reduce them to the totals that the main process aggregates.
+    # This keeps the amount of data sent between processes constant, however large the chunk is
+    return n, trial_array.sum(axis=0), (trial_array ** 2).sum(axis=0)
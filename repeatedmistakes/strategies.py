@@ -5,6 +5,18 @@ All strategies should inherit from the Strategy abstract base class to make use
 of histories and possibly other functions down the track
 """
 from abc import abstractmethod
+from collections import namedtuple
+
+# Integer encodings of cooperation and defection. A strategy created with C=COOPERATE and D=DEFECT plays integer moves,
+# which lets the simulation kernels index payoff tables directly and flip a move with a subtraction
+COOPERATE = 0
+DEFECT = 1
+
+# A strategy written as a finite state machine over the integer moves. The strategy starts in initial_state and plays
+# moves[state] in each round, then moves to transitions[state][own_move][opponent_move] given the moves that were
+# actually played. Every strategy here can be written this way, which lets the batched simulations play many games of
+# many strategies at once with nothing but table lookups.
+StateMachine = namedtuple('StateMachine', ['initial_state', 'moves', 'transitions'])
 
 
 class InvalidActionError(BaseException):
@@ -16,6 +28,15 @@ class HistoryLengthMismatch(BaseException):
 
 
 class Strategy():
+    # The move played in the first round of the game by strategies that only look at the last round, as COOPERATE or
+    # DEFECT
+    first_move = COOPERATE
+
+    # For strategies that only look at the last round, the move played after each outcome of the last round as a
+    # table indexed by [own_last_move][opponent_last_move], using COOPERATE and DEFECT. Children that need more memory
+    # than this leave it as None and override state_machine
+    response = None
+
     def __init__(self, C='C', D='D'):
         """
         Initialise the strategy's history to empty and define the symbols used to represent cooperation and defection
@@ -26,6 +47,22 @@ class Strategy():
         """
         self.C = C
         self.D = D
+        # Translate the state machine into this strategy's characterset once, so that the fast path is nothing but
+        # table lookups. Strategies that can't be written as a state machine only get the validated path
+        try:
+            machine = self.state_machine()
+        except NotImplementedError:
+            machine = None
+        if machine is not None:
+            symbols = {COOPERATE: C, DEFECT: D}
+            self._initial_state = machine.initial_state
+            self._moves = [symbols[move] for move in machine.moves]
+            self._transitions = [{symbols[own]: {symbols[opponent]: transition[own][opponent]
+                                                 for opponent in (COOPERATE, DEFECT)}
+                                  for own in (COOPERATE, DEFECT)}
+                                 for transition in machine.transitions]
+        else:
+            self._initial_state = None
         self.history = []
 
     @property
@@ -36,17 +73,31 @@ class Strategy():
     def history(self, new_history):
         if set(new_history) <= {self.C, self.D}:
             self.reset()
-            self._history = new_history
+            # Keep a list whatever iterable we were given, such as a string, so that observe can append to it in place
+            self._history = list(new_history)
         else:
             raise InvalidActionError("New history \n" + str(new_history) + "\n does not match the current " +
                                      "characterset\nC = " + str(self.C) + ", D = " + str(self.D))
 
-    def next_move(self, opponent_history):
+    @property
+    def has_state_machine(self):
+        """
+        Whether the strategy can be written as a state machine, so that fast_next_move doesn't need the histories
+        """
+        return self._initial_state is not None
+
+    def next_move(self, opponent_history, validate=True):
         """
         This method validates the history string and then gets the next move of the strategy.
 
+        Validating the history means scanning all of it, which makes a game quadratic in its length. Internal callers
+        that only ever pass a history that has already been through the history setter of the other player, and that
+        keep the two histories in step, can skip this by passing validate=False.
+
         Args:
             opponent_history (iterable): An iterable representing the the history of the oppoentn's moves
+            validate (bool): Whether to check the opponent history against the characterset and our history. Defaults
+                to True.
 
         Raises:
             InvalidActionError: Raised if any of the items in the opponent_history do not match either self.C or
@@ -60,12 +111,13 @@ class Strategy():
         Returns:
             action: The action taken by the strategy, either a C or a D
         """
-        if not set(opponent_history) <= set([self.C, self.D]):
-            raise InvalidActionError("Action must be either " + str(self.C) + " or " + str(self.D))
+        if validate:
+            if not set(opponent_history) <= set([self.C, self.D]):
+                raise InvalidActionError("Action must be either " + str(self.C) + " or " + str(self.D))
 
-        if len(opponent_history) != len(self.history):
-            raise HistoryLengthMismatch("Internal history was of length " + str(len(self.history)) + " and opponent" +
-                                        " history was of length " + str(len(opponent_history)))
+            if len(opponent_history) != len(self.history):
+                raise HistoryLengthMismatch("Internal history was of length " + str(len(self.history)) + " and " +
+                                            "opponent history was of length " + str(len(opponent_history)))
 
         action = self._strategy(opponent_history)
         return action
@@ -78,6 +130,49 @@ class Strategy():
         This method should not peform any update of internal state or history
         """
 
+    def fast_next_move(self, opponent_history=None):
+        """
+        Get the next move of the strategy without validating anything, for callers that play a game one round at a time
+
+        This skips the characterset and length checks done by next_move. The move is looked up from the current state
+        of the strategy's state machine, so nothing needs to look at the histories. The caller is trusted to have
+        recorded every previous round with observe() or fast_observe().
+
+        Strategies that can't be written as a state machine fall back to next_move without validation, so they need
+        the opponent's history. fast_observe keeps their own history for them.
+
+        Args:
+            opponent_history (iterable): The history of the opponent's moves. Only used by strategies without a state
+                machine.
+
+        Returns:
+            action: The action taken by the strategy, either a C or a D
+        """
+        if self._initial_state is None:
+            return self.next_move(opponent_history, validate=False)
+        return self._moves[self._state]
+
+    def state_machine(self):
+        """
+        Describe the strategy as a finite state machine over the integer moves COOPERATE and DEFECT
+
+        The default implementation builds the machine from first_move and response. There is a state for each outcome
+        of the last round, numbered 2 * own_last_move + opponent_last_move, and a final state for the first round.
+
+        Raises:
+            NotImplementedError: Raised if the strategy doesn't have a response table and doesn't override this method
+
+        Returns:
+            machine (StateMachine): The state machine that plays this strategy
+        """
+        if self.response is None:
+            raise NotImplementedError(type(self).__name__ + " does not define a response table or a state machine")
+        outcomes = [(own, opponent) for own in (COOPERATE, DEFECT) for opponent in (COOPERATE, DEFECT)]
+        moves = tuple(self.response[own][opponent] for own, opponent in outcomes) + (self.first_move,)
+        # The next state only depends on the moves that were just played, not on the current state
+        transition = tuple(tuple(2 * own + opponent for opponent in (COOPERATE, DEFECT)) for own in (COOPERATE, DEFECT))
+        return StateMachine(initial_state=len(outcomes), moves=moves, transitions=(transition,) * len(moves))
+
     def opposite(self, move):
         """
         Returns the opposite move to the one given, in the context of this strategy's characterset
@@ -96,6 +191,44 @@ class Strategy():
             else:
                 return self.D
 
+    def observe(self, own_move, opponent_move):
+        """
+        Record the moves that were played in a round of the game
+
+        This appends our move to the history in place, which is much cheaper than assigning a new history for callers
+        that play a game one round at a time, and updates the state used by the fast path. The move is not validated,
+        so callers are trusted to only pass moves from the characterset.
+
+        Args:
+            own_move: The move that this strategy actually played in the round
+            opponent_move: The move that the opponent actually played in the round
+        """
+        # Strategies without a state machine already append to the history in fast_observe
+        if self._initial_state is not None:
+            self._history.append(own_move)
+        self.fast_observe(own_move, opponent_move)
+
+    def fast_observe(self, own_move, opponent_move):
+        """
+        Record the moves that were played in a round of the game, keeping only what fast_next_move needs
+
+        This moves the state machine on to its next state without touching the history, so it takes constant time and
+        memory however long the game is. Callers that only use fast_next_move should record the rounds with this rather
+        than observe. Strategies without a state machine pick their moves from the history, so for them this appends to
+        the history just as observe does.
+
+        Any children of this class that keep track of extra state about the game should override this method to update
+        it, so that they don't need to rescan the histories every round.
+
+        Args:
+            own_move: The move that this strategy actually played in the round
+            opponent_move: The move that the opponent actually played in the round
+        """
+        if self._initial_state is not None:
+            self._state = self._transitions[self._state][own_move][opponent_move]
+        else:
+            self._history.append(own_move)
+
     def reset(self):
         """
         This method resets the state of the strategy to an empty history
@@ -104,12 +237,16 @@ class Strategy():
         variable as necessary
         """
         self._history = []
+        self._state = self._initial_state
 
 
 class AllC(Strategy):
     """
     A class implementing the AllC strategy that always cooperates
     """
+    first_move = COOPERATE
+    response = ((COOPERATE, COOPERATE), (COOPERATE, COOPERATE))
+
     def _strategy(self, opponent_history):
         """
         This strategy always returns a C regardless of the opponent's move
@@ -124,6 +261,9 @@ class AllD(Strategy):
     """
     A class implementing the AllD strategy that always defects
     """
+    first_move = DEFECT
+    response = ((DEFECT, DEFECT), (DEFECT, DEFECT))
+
     def _strategy(self, opponent_history):
         """
         This strategy always returns a D regardless of the opponent's move
@@ -139,6 +279,9 @@ class TitForTat(Strategy):
     A class implementing the tit for tat strategy. This strategy cooperates in the first round and the copies the
     opponent thereafter
     """
+    first_move = COOPERATE
+    response = ((COOPERATE, DEFECT), (COOPERATE, DEFECT))
+
     def _strategy(self, opponent_history):
         if len(self.history) == 0:
             return self.C
@@ -154,6 +297,9 @@ class InverseTitForTat(Strategy):
     A class implementing the inverse tit for tat strategy. This strategy cooperates in the first round and then does
     the opposite of the opponent's last move thereafter
     """
+    first_move = COOPERATE
+    response = ((DEFECT, COOPERATE), (DEFECT, COOPERATE))
+
     def _strategy(self, opponent_history):
         if len(self.history) == 0:
             return self.C
@@ -169,6 +315,9 @@ class SuspiciousTitForTat(Strategy):
     A class implementing the suspicious tit for tat strategy. This strategy defects in the first round, then copies
     the opponent thereafter
     """
+    first_move = DEFECT
+    response = ((COOPERATE, DEFECT), (COOPERATE, DEFECT))
+
     def _strategy(self, opponent_history):
         if len(self.history) == 0:
             return self.D
@@ -184,6 +333,9 @@ class SuspiciousInverseTitForTat(Strategy):
     A class implementing the suspicious inverse tit for tat strategy. This strategy defects in the first round and
     then does the opposite of the opponent's last move thereafter
     """
+    first_move = DEFECT
+    response = ((DEFECT, COOPERATE), (DEFECT, COOPERATE))
+
     def _strategy(self, opponent_history):
         if len(self.history) == 0:
             return self.D
@@ -199,6 +351,9 @@ class NiceAllD(Strategy):
     A class implementing the nice alld strategy. This strategy cooperates in the first round and then defects for all
     other rounds.
     """
+    first_move = COOPERATE
+    response = ((DEFECT, DEFECT), (DEFECT, DEFECT))
+
     def _strategy(self, opponent_history):
         if len(self.history) == 0:
             return self.C
@@ -211,6 +366,9 @@ class SuspiciousAllC(Strategy):
     A class implementing the suspicious allc strategy. This strategy defects in the first round and the cooperates
     for all other rounds.
     """
+    first_move = DEFECT
+    response = ((COOPERATE, COOPERATE), (COOPERATE, COOPERATE))
+
     def _strategy(self, opponent_history):
         if len(self.history) == 0:
             return self.D
@@ -223,18 +381,41 @@ class Grim(Strategy):
     A class implementing the Grim strategy. This strategy cooperates until the first defection, the defects forever.
     """
     def _strategy(self, opponent_history):
-        # Check whether the opponent has defected
-        if self.D in opponent_history:
+        # Check whether the opponent has defected. Any rounds that we've observed have already been checked, and the
+        # state machine is in state 1 if they contained a defection, so we only need to scan the rest of the opponent's
+        # history. Rounds loaded through the history setter weren't observed, and come before the observed rounds. When
+        # the rounds were observed without keeping the history there are no loaded rounds
+        loaded_rounds = max(len(self.history) - self._observed_rounds, 0)
+        if (self._state == 1 or self.D in opponent_history[:loaded_rounds] or
+                self.D in opponent_history[loaded_rounds + self._observed_rounds:]):
             return self.D
         else:
             return self.C
 
+    def state_machine(self):
+        # State 0 is before the opponent has defected and state 1 is after, which we never leave
+        transitions = (((0, 1), (0, 1)),
+                       ((1, 1), (1, 1)))
+        return StateMachine(initial_state=0, moves=(COOPERATE, DEFECT), transitions=transitions)
+
+    def fast_observe(self, own_move, opponent_move):
+        Strategy.fast_observe(self, own_move, opponent_move)
+        # Count the rounds that the state machine has seen
+        self._observed_rounds += 1
+
+    def reset(self):
+        Strategy.reset(self)
+        self._observed_rounds = 0
+
 
 class WSLS(Strategy):
     """
     A class implementing the Win Stay Lose Shift strategy. If the result is a CC or a DC, they will stay with their
     current move. If it's a DD or a CD they will shift to the other move.
     """
+    first_move = COOPERATE
+    response = ((COOPERATE, DEFECT), (DEFECT, COOPERATE))
+
     def _strategy(self, opponent_history):
         # Cooperate in the first round
         if len(self.history) == 0:
@@ -266,8 +447,9 @@ class TFNT(Strategy):
         n (int): The number of rounds to check for a cooperation
     """
     def __init__(self, C='C', D='D', n=2):
-        Strategy.__init__(self, C, D)
+        # The state machine depends on n, so it needs to be set before the strategy is initialised
         self.n = n
+        Strategy.__init__(self, C, D)
 
     def _strategy(self, opponent_history):
         # If the strategy's history is less than n, cooperate
@@ -283,5 +465,11 @@ class TFNT(Strategy):
             else:
                 return self.D
 
+    def state_machine(self):
+        # The state is the number of times in a row the opponent has defected, counting no higher than n
+        moves = tuple(DEFECT if state == self.n else COOPERATE for state in range(self.n + 1))
+        transitions = tuple(((0, min(state + 1, self.n)),) * 2 for state in range(self.n + 1))
+        return StateMachine(initial_state=0, moves=moves, transitions=transitions)
+
 # Keep a list of all of the strategies
 strategy_list = [AllC, AllD, TitForTat, InverseTitForTat, SuspiciousTitForTat, SuspiciousInverseTitForTat, NiceAllD, SuspiciousAllC, Grim, WSLS, TFNT]
@@ -0,0 +1,53 @@
+from repeatedmistakes.analytic import analytic_payoff
+from repeatedmistakes.strategies import *
+from repeatedmistakes.repeatedgame import PrisonersDilemmaPayoff
+from repeatedmistakes.tests.test_calculations import strategy_combinations, results_list
+
+from hypothesis import given
+from hypothesis.strategies import tuples, floats, sampled_from
+import nose
+"""
+Test the exact Markov chain calculation of the payoffs. Without mistakes we can check it against the exact values from
+Garcia and Traulsen that are used to test the calculations, and with mistakes we can check it against strategies whose
+moves don't depend on the history, where the payoff of every round is the same.
+"""
+# The global tolerance between expected and actual values. There is no truncation here, so this only has to cover
+# floating point error
+TOLERANCE = 1e-9
+
+small_float = floats(min_value=0, max_value=10)
+
+@given(payoff_values=tuples(small_float, small_float, small_float, small_float),
+       delta=floats(min_value=0.01, max_value=0.99),
+       combo=sampled_from(list(zip(strategy_combinations, results_list))))
+def test_analytic_noMistakes_ExpectedResultReturned(payoff_values, delta, combo):
+    """Test that the exact payoff for combinations of strategies with memory <= 1 matches the expected result."""
+    payoff_matrix = PrisonersDilemmaPayoff(P=payoff_values[0], R=payoff_values[1],
+                                           S=payoff_values[2], T=payoff_values[3])
+    first_strategy, second_strategy = combo[0]
+    expected_result = combo[1](payoff_matrix, delta)
+    actual_result, _ = analytic_payoff(first_strategy, second_strategy, payoff_matrix, delta)
+    assert abs(expected_result - actual_result) <= TOLERANCE * max(1, abs(expected_result))
+
+@given(payoff_values=tuples(small_float, small_float, small_float, small_float),
+       delta=floats(min_value=0.01, max_value=0.99),
+       mu=floats(min_value=0, max_value=0.5),
+       combo=sampled_from([(AllC, AllC), (AllC, AllD), (AllD, AllC), (AllD, AllD)]))
+def test_analytic_memorylessStrategiesWithMistakes_ExpectedResultReturned(payoff_values, delta, mu, combo):
+    """Test that the exact payoff for strategies that ignore the history matches the payoff of a single round."""
+    payoff_matrix = PrisonersDilemmaPayoff(P=payoff_values[0], R=payoff_values[1],
+                                           S=payoff_values[2], T=payoff_values[3])
+    first_strategy, second_strategy = combo
+    intended_one = COOPERATE if first_strategy is AllC else DEFECT
+    intended_two = COOPERATE if second_strategy is AllC else DEFECT
+    # Every round has the same expected payoff, so the normalised payoff is just the expected payoff of one round
+    expected_result = 0.
+    for move_one in (COOPERATE, DEFECT):
+        for move_two in (COOPERATE, DEFECT):
+            probability = ((1 - mu) if move_one == intended_one else mu) * ((1 - mu) if move_two == intended_two else mu)
+            expected_result += probability * payoff_matrix.payoff_idx(move_one, move_two)[0]
+    actual_result, _ = analytic_payoff(first_strategy, second_strategy, payoff_matrix, delta, mu)
+    assert abs(expected_result - actual_result) <= TOLERANCE * max(1, abs(expected_result))
+
+if __name__ == '__main__':
+    nose.main()
@@ -1,10 +1,12 @@
-from repeatedmistakes.calculations import calculate_payoff
+from repeatedmistakes.calculations import calculate_payoff, calculate_payoff_with_mistakes
+from repeatedmistakes import calculations_multiprocessed
 from repeatedmistakes.strategies import *
 from repeatedmistakes.repeatedgame import PrisonersDilemmaPayoff
 
 from hypothesis import given
 from hypothesis.strategies import tuples, floats, sampled_from
 import nose
+from nose.tools import raises
 """
 In order to test that our normalised payoff function is calculating the correct values, we will attempt to replicate
 the results found in Garcia and Traulsen, "The Structure of Mutations and the Evolution of Cooperation", PLoS ONE 10(10)
@@ -236,5 +238,51 @@ def test_calculations_singleResultCombosGiven_ExpectedResultReturned(payoff_valu
     else:
         assert abs(expected_result - actual_result) <= TOLERANCE
 
+# With mistakes, the exact Markov chain method should agree with the naive tree expansion up to the truncation error
+@given(combo=tuples(sampled_from(strategy_list), sampled_from(strategy_list)))
+def test_calculationsWithMistakes_markovMethod_matchesNaiveMethod(combo):
+    """Test that the markov method gives the same result as the naive method for any pair of strategies"""
+    payoff_matrix = PrisonersDilemmaPayoff()
+    naive_result = calculate_payoff_with_mistakes(combo[0], combo[1], payoff_matrix, 0.5, 0.01, 1e-6, 'naive')
+    markov_result = calculate_payoff_with_mistakes(combo[0], combo[1], payoff_matrix, 0.5, 0.01, 1e-6, 'markov')
+    assert abs(naive_result[0] - markov_result[0]) <= TOLERANCE
+    assert abs(naive_result[1] - markov_result[1]) <= TOLERANCE
+
+# The forward method truncates the same series as the naive method, just with the branches merged, so it should agree
+# with the exact result just as closely even with a lot of mistakes
+@given(combo=tuples(sampled_from(strategy_list), sampled_from(strategy_list)),
+       delta=floats(min_value=0.01, max_value=0.95),
+       mu=floats(min_value=0, max_value=0.5))
+def test_calculationsWithMistakes_forwardMethod_matchesMarkovMethod(combo, delta, mu):
+    """Test that the forward method gives the same result as the markov method for any pair of strategies"""
+    payoff_matrix = PrisonersDilemmaPayoff()
+    forward_result = calculate_payoff_with_mistakes(combo[0], combo[1], payoff_matrix, delta, mu, 1e-6, 'forward')
+    markov_result = calculate_payoff_with_mistakes(combo[0], combo[1], payoff_matrix, delta, mu, 1e-6, 'markov')
+    assert abs(forward_result[0] - markov_result[0]) <= TOLERANCE
+    assert abs(forward_result[1] - markov_result[1]) <= TOLERANCE
+
+# The multiprocessed calculation only hands the tree out to the pool when it is too big to expand in one process, so we
+# pick parameters that give a big enough tree and check it agrees with the naive method. Both expand exactly the same
+# tree, so they should only differ by rounding
+def test_multiprocessedCalculations_largeTree_matchesNaiveMethod():
+    """Test that the multiprocessed calculation matches the naive method when the tree is expanded by the pool"""
+    payoff_matrix = PrisonersDilemmaPayoff()
+    delta, mu, epsilon = 0.8, 0.1, 1e-5
+    assert calculations_multiprocessed.tree_size(delta, mu, payoff_matrix.max(), epsilon,
+                                                 calculations_multiprocessed.SERIAL_NODE_LIMIT) >= \
+        calculations_multiprocessed.SERIAL_NODE_LIMIT
+    for strategy_one, strategy_two in [(TitForTat, WSLS), (Grim, TFNT), (SuspiciousTitForTat, AllC)]:
+        naive_result = calculate_payoff_with_mistakes(strategy_one, strategy_two, payoff_matrix, delta, mu, epsilon,
+                                                      'naive')
+        multiprocessed_result = calculations_multiprocessed.calculate_payoff_with_mistakes(
+            strategy_one, strategy_two, payoff_matrix, delta, mu, epsilon)
+        assert abs(naive_result[0] - multiprocessed_result[0]) <= 1e-9
+        assert abs(naive_result[1] - multiprocessed_result[1]) <= 1e-9
+
+@raises(ValueError)
+def test_calculationsWithMistakes_unknownMethod_raisesValueError():
+    """Test that asking for a method that doesn't exist raises a ValueError"""
+    calculate_payoff_with_mistakes(AllC, AllC, PrisonersDilemmaPayoff(), 0.5, 0.01, 1e-6, 'unknown')
+
 if __name__ == '__main__':
     nose.main()
@@ -0,0 +1,136 @@
+from repeatedmistakes.expected_only import expected_only, mistake_limit
+from repeatedmistakes.analytic import markov_chain
+from repeatedmistakes.strategies import *
+from repeatedmistakes.repeatedgame import PrisonersDilemmaPayoff
+
+from math import comb, floor
+import numpy as np
+from hypothesis import given
+from hypothesis.strategies import tuples, floats, sampled_from
+import nose
+"""
+Test the expected only approximation. It only keeps the games of the expected length, so rather than the whole payoff
+we check it against the term of the series for that length, which we can work out exactly from the Markov chain of the
+strategies' state machines. Leaving out the games with too many mistakes can only move the result by as much as those
+games could possibly be worth, so we check it is within that bound.
+"""
+# The tolerance for floating point error between two ways of adding up the same terms
+TOLERANCE = 1e-9
+
+
+class HistoryTitForTat(TitForTat):
+    """
+    Tit for tat without its state machine, so that expected_only has to build the games from the histories
+    """
+    def state_machine(self):
+        raise NotImplementedError("HistoryTitForTat only plays from its history")
+
+
+def expected_length_term(strategy_one, strategy_two, payoff_matrix, continuation_probability, mistake_probability):
+    """
+    Compute the term of the payoff for games of exactly the expected length, with any number of mistakes
+
+    This steps the distribution over the states of the game forward one round at a time, adding up the expected payoff
+    of each round.
+    """
+    expected_rounds = floor(1 / (1 - continuation_probability))
+    initial_state, transition_matrix, expected_payoffs = markov_chain(strategy_one, strategy_two, payoff_matrix,
+                                                                      mistake_probability)
+    distribution = np.zeros(len(transition_matrix))
+    distribution[initial_state] = 1.
+    payoffs = np.zeros(2)
+    for _ in range(expected_rounds):
+        payoffs += distribution @ expected_payoffs
+        distribution = distribution @ transition_matrix
+    return (continuation_probability ** (expected_rounds - 1)) * (1 - continuation_probability) * payoffs
+
+
+def left_out_bound(payoff_matrix, continuation_probability, mistake_probability, epsilon):
+    """
+    Bound how much the games with more mistakes than expected_only allows could add to the term
+
+    This is the probability of making more mistakes than that in a game of the expected length, times the largest total
+    payoff of a game of that length.
+    """
+    expected_rounds = floor(1 / (1 - continuation_probability))
+    most_mistakes = 2 * expected_rounds
+    max_mistakes = mistake_limit(continuation_probability, mistake_probability, epsilon)
+    probability = sum(comb(most_mistakes, k) * (mistake_probability ** k) *
+                      ((1 - mistake_probability) ** (most_mistakes - k))
+                      for k in range(max_mistakes + 1, most_mistakes + 1))
+    return ((continuation_probability ** (expected_rounds - 1)) * (1 - continuation_probability) * probability *
+            expected_rounds * payoff_matrix.max())
+
+
+def iterative_mistake_limit(continuation_probability, mistake_probability, epsilon):
+    """
+    Find the largest number of mistakes whose term is at least epsilon by counting up, as the old root find did
+    """
+    expected_rounds = floor(1 / (1 - continuation_probability))
+
+    def mistake_term(n):
+        return ((continuation_probability ** (expected_rounds - 1)) * (1 - continuation_probability) *
+                ((1 - mistake_probability) ** (2 * expected_rounds - n)) * (mistake_probability ** n))
+
+    max_mistakes = 0
+    while max_mistakes < 2 * expected_rounds and mistake_term(max_mistakes + 1) >= epsilon:
+        max_mistakes += 1
+    return max_mistakes
+
+# We want to test that expected_only gives the term of the series for games of the expected length, up to the games it
+# leaves out for having too many mistakes
+@given(combo=tuples(sampled_from(strategy_list), sampled_from(strategy_list)),
+       delta=sampled_from([0.5, 0.75, 0.8, 0.9]),
+       mu=floats(min_value=0.001, max_value=0.2),
+       epsilon=sampled_from([1e-3, 1e-6, 1e-9, 1e-12]))
+def test_expectedOnly_anyStrategies_matchesMarkovChainTerm(combo, delta, mu, epsilon):
+    """Test that expected_only is within the bound on the left out games of the exact expected length term"""
+    payoff_matrix = PrisonersDilemmaPayoff()
+    expected_result = expected_length_term(combo[0], combo[1], payoff_matrix, delta, mu)
+    actual_result = expected_only(combo[0], combo[1], payoff_matrix, delta, mu, epsilon)
+    bound = left_out_bound(payoff_matrix, delta, mu, epsilon) + TOLERANCE
+    assert abs(expected_result[0] - actual_result[0]) <= bound
+    assert abs(expected_result[1] - actual_result[1]) <= bound
+
+# When every number of mistakes is allowed, nothing is left out, so expected_only should give the term exactly
+def test_expectedOnly_everyMistakeAllowed_matchesMarkovChainTermExactly():
+    """Test that expected_only gives exactly the expected length term when no games are left out"""
+    payoff_matrix = PrisonersDilemmaPayoff()
+    for strategy_one, strategy_two in [(TitForTat, WSLS), (Grim, SuspiciousTitForTat), (TFNT, AllD), (AllC, AllC)]:
+        assert mistake_limit(0.75, 0.1, 1e-12) == 8
+        expected_result = expected_length_term(strategy_one, strategy_two, payoff_matrix, 0.75, 0.1)
+        actual_result = expected_only(strategy_one, strategy_two, payoff_matrix, 0.75, 0.1, 1e-12)
+        assert abs(expected_result[0] - actual_result[0]) <= TOLERANCE
+        assert abs(expected_result[1] - actual_result[1]) <= TOLERANCE
+
+# We want to test that building the games from the histories, the naive way, gives the same result as building them
+# from the state machines
+@given(opponent=sampled_from(strategy_list),
+       mu=floats(min_value=0.001, max_value=0.2),
+       epsilon=sampled_from([1e-3, 1e-6, 1e-12]))
+def test_expectedOnly_strategyWithoutStateMachine_matchesStateMachine(opponent, mu, epsilon):
+    """Test that expected_only gives the same result whether or not it can use the state machines"""
+    payoff_matrix = PrisonersDilemmaPayoff()
+    for first_pair, second_pair in [((TitForTat, opponent), (HistoryTitForTat, opponent)),
+                                    ((opponent, TitForTat), (opponent, HistoryTitForTat))]:
+        machine_result = expected_only(first_pair[0], first_pair[1], payoff_matrix, 0.75, mu, epsilon)
+        history_result = expected_only(second_pair[0], second_pair[1], payoff_matrix, 0.75, mu, epsilon)
+        assert abs(machine_result[0] - history_result[0]) <= TOLERANCE
+        assert abs(machine_result[1] - history_result[1]) <= TOLERANCE
+
+# We want to test that solving for the number of mistakes in closed form gives the same answer as finding the largest
+# number of mistakes whose term is at least epsilon one at a time, which is what the root find used to do
+@given(delta=floats(min_value=0.01, max_value=0.95),
+       mu=floats(min_value=0.001, max_value=0.45),
+       epsilon=sampled_from([1e-2, 1e-3, 1e-6, 1e-9, 1e-12]))
+def test_mistakeLimit_anyParameters_matchesIterativeLimit(delta, mu, epsilon):
+    """Test that the closed form number of mistakes matches counting up the terms"""
+    assert mistake_limit(delta, mu, epsilon) == iterative_mistake_limit(delta, mu, epsilon)
+
+# With no chance of a mistake, every game with a mistake has a term of zero, so none should be allowed
+def test_mistakeLimit_noMistakes_ReturnsZero():
+    """Test that no mistakes are allowed when the mistake probability is zero"""
+    assert mistake_limit(0.9, 0., 1e-6) == 0
+
+if __name__ == '__main__':
+    nose.main()
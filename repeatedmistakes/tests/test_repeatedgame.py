@@ -2,10 +2,10 @@
 Tests for the repeated game class
 """
 from repeatedmistakes import strategies
-from repeatedmistakes.repeatedgame import RepeatedGame
+from repeatedmistakes.repeatedgame import RepeatedGame, PrisonersDilemmaPayoff
 
 from hypothesis import given
-from hypothesis.strategies import sampled_from, integers
+from hypothesis.strategies import sampled_from, integers, tuples, floats
 import nose
 
 # We want to test that given any combination of strategies and any number of rounds, the result we get back from the
@@ -16,8 +16,21 @@ def test_repeatedGameSimulate_passStrategiesAndNumberOfRounds_ReturnedHistoriesM
     """Test that any simulating any number of rounds with any strategies gives results of the correct length"""
     game = RepeatedGame(strat1, strat2)
     results = game.simulate(rounds)
-    assert len(results[strat1]) == rounds
-    assert len(results[strat2]) == rounds
+    assert len(results.player_one_history) == rounds
+    assert len(results.player_two_history) == rounds
+
+# We want to test that the integer indexed payoff table gives the same payoffs as looking up the moves as symbols
+small_float = floats(min_value=0, max_value=10)
+@given(payoff_values=tuples(small_float, small_float, small_float, small_float),
+       moves=tuples(sampled_from([strategies.COOPERATE, strategies.DEFECT]),
+                    sampled_from([strategies.COOPERATE, strategies.DEFECT])))
+def test_payoffMatrix_passIntegerMoves_payoffIdxMatchesPayoff(payoff_values, moves):
+    """Test that payoff_idx on integer moves matches payoff on the corresponding symbols"""
+    payoff_matrix = PrisonersDilemmaPayoff(P=payoff_values[0], R=payoff_values[1],
+                                           S=payoff_values[2], T=payoff_values[3])
+    symbols = {strategies.COOPERATE: payoff_matrix.C, strategies.DEFECT: payoff_matrix.D}
+    expected = payoff_matrix.payoff(symbols[moves[0]], symbols[moves[1]])
+    assert tuple(payoff_matrix.payoff_idx(moves[0], moves[1])) == tuple(expected)
 
 if __name__ == '__main__':
     nose.main()
\ No newline at end of file
@@ -0,0 +1,181 @@
+from repeatedmistakes.simulations import simulate_payoff, perform_trial
+from repeatedmistakes import simulations_multiprocessed
+from repeatedmistakes.simulations_batched import simulate_payoffs, state_machine_tables, play_games
+from repeatedmistakes.calculations import calculate_payoff_with_mistakes
+from repeatedmistakes.analytic import analytic_payoff
+from repeatedmistakes.strategies import *
+from repeatedmistakes.repeatedgame import PrisonersDilemmaPayoff
+
+from numpy.random import default_rng
+import numpy as np
+from functools import partial
+from hypothesis import given
+from hypothesis.strategies import sampled_from, integers, tuples
+import nose
+from nose.tools import raises
+"""
+Test the simulations. The simulations are random, so we check them against the calculations within a tolerance, and
+where two simulations should draw exactly the same random numbers we check that they give exactly the same result.
+
+Every strategy in strategy_list can be written as a state machine, which the simulations use to play the games quickly,
+so we also define some strategies that can't be, to make sure the simulations still play them correctly.
+"""
+# The continuation probability, mistake probability and epsilon used to compare the simulations with the calculations
+DELTA = 0.8
+MU = 0.05
+EPSILON = 1e-6
+# The tolerance between the simulations and the calculations. The simulations below have a standard error of around
+# 0.05, so this is about five standard errors
+SIMULATION_TOLERANCE = 0.25
+
+
+class Alternator(Strategy):
+    """
+    A strategy that cooperates in even rounds and defects in odd rounds, and has no state machine
+    """
+    def _strategy(self, opponent_history):
+        if len(opponent_history) % 2 == 0:
+            return self.C
+        else:
+            return self.D
+
+
+class HistoryTitForTat(TitForTat):
+    """
+    Tit for tat without its state machine, so that it can only be played through next_move
+    """
+    def state_machine(self):
+        raise NotImplementedError("HistoryTitForTat only plays from its history")
+
+
+# Each simulator, set up to give a standard error of around 0.05
+simulators = [partial(simulate_payoff, estimator_stdev=0.05),
+              partial(simulate_payoff, trials=5000),
+              partial(simulations_multiprocessed.simulate_payoff, trials=5000, seed=1234)]
+
+# We want to test that the fast path used by perform_trial plays a strategy without a state machine exactly as it plays
+# the same strategy with one, given the same random numbers
+@given(opponent=sampled_from(strategy_list), seed=integers(min_value=0, max_value=1000))
+def test_performTrial_strategyWithoutStateMachine_matchesStateMachine(opponent, seed):
+    """Test that a strategy played from its history gets the same payoffs as when it is played as a state machine"""
+    payoff_matrix = PrisonersDilemmaPayoff()
+    results = []
+    for strategy in (TitForTat, HistoryTitForTat):
+        player_one = strategy(C=COOPERATE, D=DEFECT)
+        player_two = opponent(C=COOPERATE, D=DEFECT)
+        random_instance = default_rng(seed)
+        results.append([perform_trial(player_one, player_two, payoff_matrix.table, DELTA, random_instance, MU)
+                        for _ in range(10)])
+    assert results[0] == results[1]
+
+# We want to test that the adaptive simulation plays a strategy without a state machine from its history, drawing the
+# same random numbers as when the strategy is played as a state machine, so that the results are exactly the same
+@given(opponent=sampled_from(strategy_list), seed=integers(min_value=0, max_value=1000))
+def test_simulatePayoff_adaptiveWithoutStateMachine_matchesStateMachine(opponent, seed):
+    """Test that the adaptive simulation gives the same result for a strategy with or without its state machine"""
+    payoff_matrix = PrisonersDilemmaPayoff()
+    machine_result = simulate_payoff(TitForTat, opponent, payoff_matrix, DELTA, MU, seed=seed, estimator_stdev=0.5)
+    history_result = simulate_payoff(HistoryTitForTat, opponent, payoff_matrix, DELTA, MU, seed=seed,
+                                     estimator_stdev=0.5)
+    assert machine_result == history_result
+    machine_result = simulate_payoff(opponent, TitForTat, payoff_matrix, DELTA, MU, seed=seed, estimator_stdev=0.5)
+    history_result = simulate_payoff(opponent, HistoryTitForTat, payoff_matrix, DELTA, MU, seed=seed,
+                                     estimator_stdev=0.5)
+    assert machine_result == history_result
+
+# We want to test that every simulator can play strategies without a state machine, and gets about the right answer
+def test_simulators_strategyWithoutStateMachine_matchesCalculation():
+    """Test that each simulator gives about the calculated payoff when a strategy has no state machine"""
+    payoff_matrix = PrisonersDilemmaPayoff()
+    for strategy_one, strategy_two in [(Alternator, AllC), (TitForTat, Alternator), (Alternator, HistoryTitForTat)]:
+        expected_result = calculate_payoff_with_mistakes(strategy_one, strategy_two, payoff_matrix, DELTA, MU,
+                                                         EPSILON)
+        for simulator in simulators:
+            actual_result = simulator(strategy_one, strategy_two, payoff_matrix, DELTA, mistake_probability=MU)
+            assert abs(expected_result[0] - actual_result[0]) <= SIMULATION_TOLERANCE
+            assert abs(expected_result[1] - actual_result[1]) <= SIMULATION_TOLERANCE
+
+# We want to test that the batched simulations of every pair of strategies agree with the exact payoffs
+def test_simulatePayoffs_allStrategies_matchAnalyticPayoff():
+    """Test that simulate_payoffs gives about the exact payoff for every pair of strategies"""
+    payoff_matrix = PrisonersDilemmaPayoff()
+    actual_results = simulate_payoffs(strategy_list, payoff_matrix, DELTA, MU, trials=5000, seed=1234)
+    for index_one, strategy_one in enumerate(strategy_list):
+        for index_two, strategy_two in enumerate(strategy_list):
+            expected_result = analytic_payoff(strategy_one, strategy_two, payoff_matrix, DELTA, MU)
+            assert abs(expected_result[0] - actual_results[index_one, index_two, 0]) <= SIMULATION_TOLERANCE
+            assert abs(expected_result[1] - actual_results[index_one, index_two, 1]) <= SIMULATION_TOLERANCE
+
+# We want to test that a fixed number of trials played in lockstep agrees with the exact payoffs
+@given(combo=tuples(sampled_from(strategy_list), sampled_from(strategy_list)))
+def test_simulatePayoff_fixedTrials_matchesAnalyticPayoff(combo):
+    """Test that simulating a fixed number of trials gives about the exact payoff for any pair of strategies"""
+    payoff_matrix = PrisonersDilemmaPayoff()
+    expected_result = analytic_payoff(combo[0], combo[1], payoff_matrix, DELTA, MU)
+    actual_result = simulate_payoff(combo[0], combo[1], payoff_matrix, DELTA, MU, trials=5000, seed=1234)
+    assert abs(expected_result[0] - actual_result[0]) <= SIMULATION_TOLERANCE
+    assert abs(expected_result[1] - actual_result[1]) <= SIMULATION_TOLERANCE
+
+# Without mistakes, AllC against AllC gets the reward in every round, so play_games should give exactly the reward
+# times the length of each game. The lengths are the first thing play_games draws, so we can draw them again
+@given(seed=integers(min_value=0, max_value=1000))
+def test_playGames_noMistakes_payoffsMatchGameLengths(seed):
+    """Test that play_games gives each game the payoff of every round it lasted"""
+    payoff_matrix = PrisonersDilemmaPayoff()
+    initial_states, moves, transitions = state_machine_tables((AllC,))
+    games = np.zeros(100, dtype=np.intp)
+    payoffs = play_games(games, games, initial_states, moves, transitions, payoff_matrix.table, DELTA, 0.,
+                         default_rng(seed))
+    rounds = default_rng(seed).geometric(1 - DELTA, size=100)
+    assert (payoffs[:, 0] == payoff_matrix.R * rounds).all()
+    assert (payoffs[:, 1] == payoff_matrix.R * rounds).all()
+
+# An empty batch of games has no payoffs, rather than failing to find the longest game
+def test_playGames_noGames_returnsEmptyPayoffs():
+    """Test that play_games returns an empty array of payoffs when it is given no games"""
+    initial_states, moves, transitions = state_machine_tables((AllC,))
+    games = np.zeros(0, dtype=np.intp)
+    payoffs = play_games(games, games, initial_states, moves, transitions, PrisonersDilemmaPayoff().table, DELTA, MU,
+                         default_rng(1234))
+    assert payoffs.shape == (0, 2)
+
+# The mean payoff of no trials isn't defined, so asking for them should say so
+@raises(ValueError)
+def test_simulatePayoff_noTrials_raisesValueError():
+    """Test that simulating a fixed number of trials less than one raises a ValueError"""
+    simulate_payoff(AllC, AllC, PrisonersDilemmaPayoff(), DELTA, MU, trials=0)
+
+# We want to test that split_trials never drops or adds trials, whether the trials divide evenly into the chunks,
+# leave a remainder, or are fewer than the chunks
+def test_splitTrials_examples_sumToTrials():
+    """Test that the chunks add up to exactly the number of trials for some awkward cases"""
+    for trials, chunks in [(1000, 48), (5, 16), (1000, 10), (1, 1), (0, 4)]:
+        trial_chunks = simulations_multiprocessed.split_trials(trials, chunks)
+        assert sum(trial_chunks) == trials
+        assert all(chunk > 0 for chunk in trial_chunks)
+
+@given(trials=integers(min_value=0, max_value=100000), chunks=integers(min_value=1, max_value=1000))
+def test_splitTrials_anyTrials_sumToTrials(trials, chunks):
+    """Test that the chunks add up to exactly the number of trials, and every chunk has at least one trial"""
+    trial_chunks = simulations_multiprocessed.split_trials(trials, chunks)
+    assert sum(trial_chunks) == trials
+    assert all(chunk > 0 for chunk in trial_chunks)
+
+# We want to test that the multiprocessed simulation is reproducible. Each chunk of trials is seeded from the seed we
+# pass, so the same seed should give exactly the same result however the chunks were shared between the processes
+def test_multiprocessedSimulatePayoff_sameSeed_sameResult():
+    """Test that the multiprocessed simulation gives the same result for the same seed, and not for a different one"""
+    payoff_matrix = PrisonersDilemmaPayoff()
+    for strategy_one, strategy_two in [(TitForTat, WSLS), (Grim, Alternator)]:
+        for options in [dict(trials=2000), dict(estimator_stdev=0.05)]:
+            first_result = simulations_multiprocessed.simulate_payoff(strategy_one, strategy_two, payoff_matrix, DELTA,
+                                                                      MU, seed=1234, **options)
+            second_result = simulations_multiprocessed.simulate_payoff(strategy_one, strategy_two, payoff_matrix, DELTA,
+                                                                       MU, seed=1234, **options)
+            other_result = simulations_multiprocessed.simulate_payoff(strategy_one, strategy_two, payoff_matrix, DELTA,
+                                                                      MU, seed=4321, **options)
+            assert first_result == second_result
+            assert first_result != other_result
+
+if __name__ == '__main__':
+    nose.main()
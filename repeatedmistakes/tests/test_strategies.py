@@ -1,5 +1,5 @@
 from hypothesis import given, assume
-from hypothesis.strategies import text, just, integers, tuples, sampled_from
+from hypothesis.strategies import text, just, integers, tuples, sampled_from, lists
 import nose
 from nose.tools import raises
 
@@ -111,6 +111,74 @@ def test_strategy_passHistoryThenReset_historyIsEmpty(history, strategy):
     test_object.history = strat_history
     test_object.reset()
     assert test_object.history == []
+
+# We want to test that the unvalidated fast path used by the simulations agrees with next_move. We feed both paths the
+# same rounds one at a time, where the moves in each round are arbitrary so that mistakes are covered as well
+@given(rounds = lists(tuples(sampled_from([COOPERATE, DEFECT]), sampled_from([COOPERATE, DEFECT]))),
+       strategy = sampled_from(strategy_list))
+def test_strategy_fastNextMove_matchesNextMove(rounds, strategy):
+    """Test that fast_next_move returns the same move as next_move after any sequence of observed rounds"""
+    test_object = strategy(C=COOPERATE, D=DEFECT)
+    # This object only keeps the state needed by the fast path
+    fast_object = strategy(C=COOPERATE, D=DEFECT)
+    opponent_history = []
+    for own_move, opponent_move in rounds:
+        expected_move = test_object.next_move(opponent_history)
+        assert test_object.fast_next_move() == expected_move
+        assert fast_object.fast_next_move() == expected_move
+        test_object.observe(own_move, opponent_move)
+        fast_object.fast_observe(own_move, opponent_move)
+        opponent_history.append(opponent_move)
+    assert fast_object.history == []
+
+# We want to test that the state machine of each strategy, as used by the batched simulations, plays the same moves as
+# next_move after any sequence of rounds
+@given(rounds = lists(tuples(sampled_from([COOPERATE, DEFECT]), sampled_from([COOPERATE, DEFECT]))),
+       strategy = sampled_from(strategy_list))
+def test_strategy_stateMachine_matchesNextMove(rounds, strategy):
+    """Test that the moves played by the state machine of a strategy match next_move"""
+    test_object = strategy(C=COOPERATE, D=DEFECT)
+    machine = test_object.state_machine()
+    state = machine.initial_state
+    opponent_history = []
+    for own_move, opponent_move in rounds:
+        assert machine.moves[state] == test_object.next_move(opponent_history)
+        test_object.observe(own_move, opponent_move)
+        opponent_history.append(opponent_move)
+        state = machine.transitions[state][own_move][opponent_move]
+
+# We want to test that a strategy that has had its history loaded through the setter and then observed more rounds
+# plays the same move as if the whole history had been loaded at once
+@given(loaded = lists(tuples(sampled_from([COOPERATE, DEFECT]), sampled_from([COOPERATE, DEFECT]))),
+       observed = lists(tuples(sampled_from([COOPERATE, DEFECT]), sampled_from([COOPERATE, DEFECT]))),
+       strategy = sampled_from(strategy_list))
+def test_strategy_setHistoryThenObserve_matchesWholeHistorySet(loaded, observed, strategy):
+    """Test that observing rounds after setting the history gives the same move as setting the whole history"""
+    test_object = strategy(C=COOPERATE, D=DEFECT)
+    test_object.history = [own_move for own_move, _ in loaded]
+    for own_move, opponent_move in observed:
+        test_object.observe(own_move, opponent_move)
+    expected_object = strategy(C=COOPERATE, D=DEFECT)
+    expected_object.history = [own_move for own_move, _ in loaded + observed]
+    opponent_history = [opponent_move for _, opponent_move in loaded + observed]
+    assert test_object.next_move(opponent_history) == expected_object.next_move(opponent_history)
+
+# Histories can be loaded as strings of moves, so a strategy should still be able to observe more rounds after that
+@given(loaded = lists(tuples(sampled_from('CD'), sampled_from('CD'))),
+       observed = lists(tuples(sampled_from('CD'), sampled_from('CD'))),
+       strategy = sampled_from(strategy_list))
+def test_strategy_setStringHistoryThenObserve_matchesWholeHistorySet(loaded, observed, strategy):
+    """Test that observing rounds after setting the history as a string gives the same move as setting it all"""
+    test_object = strategy()
+    test_object.history = ''.join(own_move for own_move, _ in loaded)
+    for own_move, opponent_move in observed:
+        test_object.observe(own_move, opponent_move)
+    expected_object = strategy()
+    expected_object.history = [own_move for own_move, _ in loaded + observed]
+    opponent_history = [opponent_move for _, opponent_move in loaded + observed]
+    assert test_object.history == expected_object.history
+    assert test_object.next_move(opponent_history) == expected_object.next_move(opponent_history)
+
 """
 Individual strategy tests
 """
@@ -134,5 +202,14 @@ def test_AllD_passAnyHistory_ReturnsD(s):
     test_object.history = history
     assert test_object.next_move(opponent_history) == test_object.D
 
+def test_Grim_setHistoryWithDefectionThenObserve_ReturnsD():
+    """Test that Grim still sees a defection in a history that was set before observing another round"""
+    test_object = Grim()
+    test_object.history = ['C', 'C']
+    opponent_history = ['D', 'C']
+    test_object.observe('C', 'C')
+    opponent_history.append('C')
+    assert test_object.next_move(opponent_history) == 'D'
+
 if __name__ == '__main__':
     nose.main()